@@ -0,0 +1,170 @@
+#!/usr/local/bin/python
+
+# benchmark.py
+# Copyright 2013- by David H Post, DaviWorks.com.
+
+""" Compare parse engines of modsplan.syntax: recursive (parse_nonterm)
+        and explicit stack (parse_stack, debug 'u').
+    Times parses of sample sources, and finds nesting of parentheses
+        each engine can parse (recursive engine is limited by Python's recursion limit).
+    Also times parses with tracing off (no sinks) and on (events kept by a ListSink),
+        and estimates the cost of the 'if tracer.sinks:' tests made with tracing off
+        (number of tests times the time of one test, as % of parse time);
+        and times sequential and parallel parses (one process per cpu).
+"""
+
+import sys
+import os
+import timeit
+import multiprocessing
+
+from modsplan import syntax
+from modsplan import tracing
+from modsplan.lineparsers import Error
+
+
+engines = [('recursive', ''), ('stack', 'u')]   # (name, debug flags of SyntaxParser)
+spec_dir = 'modspecs/'
+source_dir = 'sample_source/'
+nesting_limit = 1024        # greatest nesting of parentheses tried
+
+
+def time_parse(parser, sourcepath, repeat=5, processes=1):
+    """ Return least time (seconds) of repeat parses of sourcepath."""
+    return min(timeit.repeat(lambda: parser.parse(sourcepath, processes=processes),
+                                number=1, repeat=repeat))
+
+
+def benchmark(sourcepaths, repeat=5):
+    """ Return (string) table of parse times of each engine for sourcepaths."""
+    line_format = '%-28s%8s' + '%12s' * len(engines) + '%8s\n'
+    names = [name for name, debug in engines]
+    table = line_format % tuple(['Source', 'Tokens'] + names + ['Ratio'])
+    table += '\n'
+    totals = [0.0] * len(engines)
+    for sourcepath in sourcepaths:
+        langname = sourcepath.rpartition('.')[-1]
+        times = []
+        try:
+            for name, debug in engines:
+                parser = syntax.SyntaxParser(os.path.join(spec_dir, langname), debug)
+                times.append(time_parse(parser, sourcepath, repeat))
+        except Error as exc:
+            print exc
+            continue
+        numtokens = len(parser.tokens)
+        totals = [total + time for total, time in zip(totals, times)]
+        columns = ['%.4f' % time for time in times] + ['%.2f' % (times[-1] / times[0])]
+        table += line_format % tuple([os.path.basename(sourcepath), numtokens] + columns)
+    table += '\n'
+    columns = ['%.4f' % total for total in totals] + ['%.2f' % (totals[-1] / totals[0])]
+    table += line_format % tuple(['Total', ''] + columns)
+    return table
+
+
+class GuardCount(list):
+    """ Empty list of sinks that counts tests of its truth (tracing stays off)."""
+    def __init__(self):
+        list.__init__(self)
+        self.tests = 0
+
+    def __nonzero__(self):
+        self.tests += 1
+        return False
+
+
+def guard_time(number=1000000):
+    """ Return time (seconds) of one 'if self.tracer.sinks:' test with tracing off."""
+    setup = 'from modsplan import tracing\nclass Traced(object): pass\n' + \
+            'self = Traced()\nself.tracer = tracing.Tracer()'
+    test = min(timeit.repeat('if self.tracer.sinks: pass', setup, number=number, repeat=3))
+    empty = min(timeit.repeat('pass', setup, number=number, repeat=3))
+    return max(test - empty, 0.0) / number
+
+
+def trace_cost(sourcepaths, repeat=5):
+    """ Return (string) table of parse times for sourcepaths with tracing off and on,
+        number of trace events, and number of tracing tests made with tracing off
+        and their estimated time as % of parse time with tracing off."""
+    line_format = '%-28s%8s%12s%12s%10s%10s%8s\n'
+    table = line_format % ('Source', 'Tokens', 'off', 'on', 'Events', 'Tests', 'Tests%')
+    table += '\n'
+    test_time = guard_time()
+    for sourcepath in sourcepaths:
+        langname = sourcepath.rpartition('.')[-1]
+        parser = syntax.SyntaxParser(os.path.join(spec_dir, langname))
+        try:
+            untraced = time_parse(parser, sourcepath, repeat)
+            parser.tracer.sinks = counter = GuardCount()
+            parser.parse(sourcepath)
+            parser.tracer.sinks = []
+            sink = parser.tracer.add(tracing.ListSink())
+            traced = time_parse(parser, sourcepath, repeat)
+        except Error as exc:
+            print exc
+            continue
+        numevents = len(sink.events) / repeat
+        percent = 100 * counter.tests * test_time / untraced
+        table += line_format % (os.path.basename(sourcepath), len(parser.tokens),
+                                '%.4f' % untraced, '%.4f' % traced, numevents,
+                                counter.tests, '%.2f' % percent)
+    table += '\nOne test of tracer.sinks takes %.1f ns\n' % (test_time * 1e9)
+    return table
+
+
+def parallel_cost(sourcepaths, processes, repeat=5):
+    """ Return (string) table of parse times for sourcepaths parsed sequentially and
+        by processes in parallel, and number of chunks parsed in parallel."""
+    line_format = '%-28s%8s%12s%12s%8s\n'
+    table = line_format % ('Source', 'Tokens', 'sequential', 'parallel', 'Chunks')
+    table += '\n'
+    for sourcepath in sourcepaths:
+        langname = sourcepath.rpartition('.')[-1]
+        parser = syntax.SyntaxParser(os.path.join(spec_dir, langname))
+        try:
+            sequential = time_parse(parser, sourcepath, repeat)
+            parallel = time_parse(parser, sourcepath, repeat, processes)
+        except Error as exc:
+            print exc
+            continue
+        table += line_format % (os.path.basename(sourcepath), len(parser.tokens),
+                                '%.4f' % sequential, '%.4f' % parallel, parser.chunks)
+    return table
+
+
+def nesting(depth):
+    """ Return calc source of a number inside depth pairs of parentheses."""
+    return '(' * depth + '1' + ')' * depth
+
+
+def max_nesting(debug, limit=nesting_limit):
+    """ Return greatest nesting of parentheses (up to limit, by doubling)
+        that calc parser with debug flags parses."""
+    parser = syntax.SyntaxParser(os.path.join(spec_dir, 'calc'), debug)
+    depth = 1
+    while depth * 2 <= limit:
+        try:
+            parser.parse_from(nesting(depth * 2), 'nesting.calc')
+        except RuntimeError:        # maximum recursion depth exceeded
+            break
+        depth *= 2
+    return depth
+
+
+if __name__ == '__main__':
+    sourcepaths = sys.argv[1:]
+    if not sourcepaths:
+        sourcepaths = [os.path.join(source_dir, filename)
+                            for filename in sorted(os.listdir(source_dir))
+                            if os.path.isfile(os.path.join(spec_dir,
+                                filename.rpartition('.')[-1] + '.syntax'))]
+    print benchmark(sourcepaths)
+    print 'Tracing:'
+    print trace_cost(sourcepaths)
+    processes = multiprocessing.cpu_count()
+    if processes > 1:
+        print 'Parallel parse (%d processes):' % processes
+        print parallel_cost(sourcepaths, processes)
+    print 'Nesting of parentheses parsed (up to %d):' % nesting_limit
+    for name, debug in engines:
+        print '    %-12s%8d' % (name, max_nesting(debug))
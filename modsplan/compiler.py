@@ -6,8 +6,9 @@
 
 import sys
 import os.path
+import multiprocessing
 
-from lineparsers import Error
+from lineparsers import Error, uncompressed_path
 
 import syntax
 import defn
@@ -28,6 +29,8 @@ class Compiler:
             Optional specification directory, debugging flags."""
         self.langname = langname
         self.debug = debug          # debugging flags
+        # number of processes to parse source (one per cpu if parsing in parallel)
+        self.processes = multiprocessing.cpu_count() if 'x' in debug else 1
         self.source_tree = None     # last tree parsed from source
         if spec_dir == None:
             spec_dir = default_spec_dir
@@ -56,8 +59,25 @@ class Compiler:
             return lines of target code, indented appropriately."""
         if '2' in self.debug:
             print '\nParsing %s ...' % source_filepath
-        self.source_tree = self.parser.parse(source_filepath)
-        
+        tree = self.parser.parse(source_filepath, stream=('l' in self.debug),
+                                    processes=self.processes)
+        return self.compile_tree(tree)
+
+
+    def compile_from(self, source, name='<string>'):
+        """ Compile source code from a string, or an iterable of lines (such as a
+                file object), for initialized language; name is used in error messages.
+            Return lines of target code, as for compile()."""
+        if '2' in self.debug:
+            print '\nParsing %s ...' % name
+        tree = self.parser.parse_from(source, name, stream=('l' in self.debug),
+                                        processes=self.processes)
+        return self.compile_tree(tree)
+
+
+    def compile_tree(self, tree):
+        """ Compile parse tree of source code, return lines of target code."""
+        self.source_tree = tree
         self.labelsuffix.clear()
         self.comments = []
         self.level = 0
@@ -67,9 +87,7 @@ class Compiler:
         codelines = []
         
         # Output initial comments
-        for child in self.source_tree.children:
-            if child.name == 'COMMENT':
-                codelines += [';' + child.findtext()]
+        codelines += [';' + comment.text for comment in self.source_tree.comments]
         
         # Generate code
         codelines += self.codegen(self.source_tree)
@@ -106,8 +124,7 @@ class Compiler:
         
         else:   # no definition found; generate code for any children
             if source_node.isterminal():
-                if source_node.name != 'COMMENT':
-                    code += [source_node.findtext()]    # insert text of terminal nodes
+                code += [source_node.findtext()]    # insert text of terminal nodes
             else:
                 for child in source_node.children:
                     code += self.codegen(child, use)
@@ -200,9 +217,7 @@ class Compiler:
         
         # Collect comments
         if not source_node.isterminal():
-            for child in source_node.children:
-                if child.name == 'COMMENT':
-                    self.comments += [';' + child.findtext()]
+            self.comments += [';' + comment.text for comment in source_node.comments]
         
         if self.level == 0:             # if generating whole instructions,
             code += self.comments       #   output collected comments
@@ -326,9 +341,10 @@ class Compiler:
 def compile_src(sourcepath, codepath='', spec_dir=None, debug=''):
     """ Compile source code from sourcepath, write target code to codepath (if given),
         return lines of target code in a single string.
-        If codepath is '*', write to sourcepath.<code_suffix>.
+        If codepath is '*', write to sourcepath.<code_suffix>
+            (without any compressed suffix of sourcepath, e.g. '.gz').
         Optional specification directory and debug flags."""
-    langname = sourcepath.rpartition('.')[-1]
+    langname = uncompressed_path(sourcepath).rpartition('.')[-1]
     
     try:
         compiler = Compiler(langname, spec_dir, debug)      # initialize for langname
@@ -336,7 +352,7 @@ def compile_src(sourcepath, codepath='', spec_dir=None, debug=''):
         codestring = '\n'.join(code) + '\n'
         if codepath:
             if codepath == '*':
-                codepath = sourcepath + '.' + code_suffix
+                codepath = uncompressed_path(sourcepath) + '.' + code_suffix
             with open(codepath, 'w') as outfile:
                 outfile.write(codestring)
         return codestring
@@ -376,15 +392,24 @@ if __name__ == '__main__':
         5 = parse trace: show tokens found and not found
         a = ambiguous parse permitted (error suppressed)
         b = show traceback on error
+        c = memoize parses of nonterms (packrat parsing)
         d = show definitions (signatures with instruction trees)
         e = show tree of language definitions
+        f = ordered choice: keep first successful alternate (unless nonterm is .longest)
         g = list definition signatures
+        h = profile parse: table of costs of nonterms and alternates, most time first
         i = show instructions generated for each definition used
+        j = profile parse: costs of nonterms and alternates as JSON
+        k = parse without bracket index (try alternates in any region)
+        l = stream tokens to parser as needed (o, r ignored)
         n = use with t, 3, 4, or 5 to show line and column numbers
         o = list tokens from source file
         p = list possible prefixes for syntax nonterminals
+        q = parse without lookahead tries (try alternates that any first token allows)
         r = display source code reassembled from tokens
         s = display syntax used to parse source
         t = display parse tree
+        u = parse with explicit stack (no recursion limit on nesting of syntax)
         w = write target code to file (overwrites file)
+        x = parse top-level items in parallel, one process per cpu (ignored with l)
         """ % sys.argv[0]
@@ -54,8 +54,7 @@ class Definitions:
             signature = [signode.findtext()]
             signature += [childname(node) for node in signode.findall('child')]
         else:   # 'terminal'
-            signature = [node.findtext() for node in signode.children
-                            if node.name != 'COMMENT']
+            signature = [node.findtext() for node in signode.children]
         signature = map(remove_quotes, signature)
         ### need to get subtypes
         return tuple(signature)
@@ -67,8 +66,7 @@ class Definitions:
             signature.append(source_node.text)
         else:
             for child in source_node.children:
-                if child.name != 'COMMENT':
-                    signature.append(child.name)
+                signature.append(child.name)
         return self.defns.get(tuple(signature))
     
     def show(self, sigs_only=True):
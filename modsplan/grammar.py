@@ -22,6 +22,9 @@ class Nonterminal:
         self.name = name        # string
         self.alternates = []    # list of Alternates, productions for this nonterm
         self.prefixes = None    # set of terminals that are possible prefixes
+        self.prefix_mask = 0    # bits of prefixes (if computed, see syntax.SyntaxGrammar)
+        self.dispatch = None    # trie of lookahead of alternates (if computed)
+        self.longest = False    # True to keep longest parse of alternates in ordered mode
                                 
     def __str__(self):
         return self.name
@@ -50,10 +53,14 @@ class Alternate:
     def __init__(self, production, location, flags=None):
         self.items = production     # list of Item
         self.prefixes = None        # set of terminals that are possible prefixes
+        self.prefix_mask = 0        # bits of prefixes (if computed)
         self.location = location    # lineparsers.Location of production: filepath, linenum...
         if flags == None:
             flags = []
         self.flags = flags          # list of attribute strings
+        self.required = frozenset() # bracket tokens any match must contain (if computed)
+        self.lookahead = None       # set of sequences of terminals that may begin a match
+        self.mask = 0               # bit of alternate in lookahead masks (if computed)
     
     def __str__(self):
         return ' '.join(map(str, self.items))
@@ -161,6 +168,8 @@ class Grammar:
             'enable' commands set options.
             'use' commands include other files (see lineparsers.py).
             Last nonterminal with suffix '.root' is recorded as root.
+            Nonterminal with suffix '.longest' on any production keeps longest parse
+                when parsed with ordered choice (see syntax.SyntaxParser.parse_nonterm).
         """
         lines = lineparsers.LineInfoParser(filepath)
         for line in lines:
@@ -188,10 +197,12 @@ class Grammar:
         flags = nameflags[1:]
         nonterm = self.nonterms.setdefault(name, Nonterminal(name))     # create if not found
         # Store raw strings for now; must create nonterms before we can point to them.
-        alt = Alternate(production[2:], location, flags)
+        alt = Alternate(production[2:], location.copy(), flags)
         nonterm.alternates.append(alt)
         if 'root' in flags:
             self.root = nonterm
+        if 'longest' in flags:
+            nonterm.longest = True
 
     
     def load_items(self):
@@ -2,20 +2,40 @@
 # Modsplan line parsers
 # Copyright 2013 by David H Post, DaviWorks.com.
 
+import bz2
+import gzip
+import mmap
 import os
+import re
+from array import array
+from collections import OrderedDict
+from contextlib import closing
+from itertools import islice
+
+try:
+    import lzma                         # Python 3.3+, or backports.lzma, for .xz files
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
 """ These parsers offer convenient iteration over lines of text.
     Each inherits features of previous.
         LineParser tracks current line number.
         IndentParser tracks indentation level.
-        FileParser reads lines from a file.
-        ImportParser handles importing lines from other files.
+        FileParser reads lines from a file (lazily, from a memory mapping; see MappedLines),
+            or decompresses them as they are read (see CompressedLines).
+        TextParser reads lines from a string, or any iterable of lines (such as a file object).
+        ImportParser handles importing lines from other files (lines cached in file_cache).
         LineInfoParser provides source location of each (possibly imported) line.
 """
 
 import_command = 'use '
 
+compressed_suffixes = ['.gz', '.bz2', '.xz']    # see CompressedLines
+
 
 class Location(object):
     """ Location of a line or token in text.
@@ -34,10 +54,13 @@ class Location(object):
         return Location(self.filepath, self.lines, self.linenum, self.level, self.column)
     
     def line(self):
-        """ Line of text at this location."""
+        """ Line of text at this location ('' if its file has changed, see MappedLines)."""
         text = ''
         if self.lines and self.linenum > 0:
-            text = self.lines[self.linenum - 1]
+            try:
+                text = self.lines[self.linenum - 1]
+            except Error:
+                pass
         if self.tabsize:
             text = text.replace('\t', ' ' * self.tabsize)       # expand tabs
         return text
@@ -47,6 +70,118 @@ class Location(object):
         return Error(message, self, extra)
 
 
+class LocationTable(object):
+    """ Registry of files of source text, so that a location can be kept as an int
+            packing file id, line number, indentation level and column (see pack);
+            a Location (with the text of its line) is built only when needed.
+        Lines of the most recent max_files files are kept; for older files,
+            a Location has no line text (filepath, linenum, etc. are kept).
+            Lines kept may be large (e.g. a list of the lines of a string, or a
+            MappedLines keeping its file open), so max_files is small.
+            Each file added also takes one entry in files, never dropped:
+            positions of its tokens and nodes may be kept anywhere.
+        A packed position is meaningful only in this process (and processes forked
+            from it): see state and restore, to pickle one.
+    """
+    max_files = 32
+    column_bits = 24
+    level_bits = 8
+    linenum_bits = 31
+    file_shift = column_bits + level_bits + linenum_bits    # fileid is position >> file_shift
+
+    def __init__(self):
+        self.files = []             # files[fileid] is (filepath, tabsize), shared by fileids
+        self.names = {}             # names[(filepath, tabsize)] is that tuple, in files
+        self.file_ids = {}          # file_ids[(filepath, id(lines), tabsize)] is fileid
+        self.lines = OrderedDict()  # lines[fileid] is (lines, key), for recent files
+        self.stamp = os.urandom(8)  # tells states of positions of this table (see state)
+
+    def file_id(self, filepath, lines, tabsize=0):
+        """ Return id of file at filepath with lines of text, adding it if new;
+            tabsize is used to expand tabs to display a line."""
+        key = (filepath, id(lines), tabsize)
+        fileid = self.file_ids.get(key)
+        if fileid is None:
+            fileid = self.file_ids[key] = len(self.files)
+            self.files.append(self.names.setdefault((filepath, tabsize), (filepath, tabsize)))
+            self.keep_lines(fileid, lines, key)
+        return fileid
+
+    def set_lines(self, fileid, lines):
+        """ Replace lines of text of file fileid (e.g. after source is edited):
+            positions in the file keep their file id, and show the new lines."""
+        filepath, tabsize = self.files[fileid]
+        oldlines, oldkey = self.lines.pop(fileid, (None, None))
+        if oldkey and self.file_ids.get(oldkey) == fileid:
+            del self.file_ids[oldkey]
+        key = (filepath, id(lines), tabsize)
+        self.file_ids[key] = fileid
+        self.keep_lines(fileid, lines, key)
+
+    def keep_lines(self, fileid, lines, key):
+        """ Keep lines of file fileid (with its key in file_ids), as most recent;
+            drop (and close) lines of the least recent, if more than max_files."""
+        self.lines[fileid] = (lines, key)
+        while len(self.lines) > self.max_files:
+            oldid, (oldlines, oldkey) = self.lines.popitem(last=False)
+            if self.file_ids.get(oldkey) == oldid:
+                del self.file_ids[oldkey]       # id(oldlines) may be reused
+            close_lines(oldlines)
+
+    def pack(self, fileid, linenum, level, column):
+        """ Return int packing the fields of a location."""
+        if (linenum >> self.linenum_bits or level >> self.level_bits
+                or column >> self.column_bits):
+            raise Error('Location out of range (line %d, level %d, column %d)'
+                            % (linenum, level, column))
+        return (((fileid << self.linenum_bits | linenum) << self.level_bits | level)
+                    << self.column_bits | column)
+
+    def unpack(self, position):
+        """ Return (fileid, linenum, level, column) of packed position."""
+        column = position & ((1 << self.column_bits) - 1)
+        position >>= self.column_bits
+        level = position & ((1 << self.level_bits) - 1)
+        position >>= self.level_bits
+        linenum = position & ((1 << self.linenum_bits) - 1)
+        return int(position >> self.linenum_bits), int(linenum), int(level), int(column)
+
+    def state(self, position):
+        """ Return picklable state of packed position: (stamp, (filepath, tabsize), position)."""
+        return (self.stamp, self.files[position >> self.file_shift], position)
+
+    def restore(self, state):
+        """ Return packed position from state (see state): the same if state is from
+                this table (in this process, or one forked from it), else with the id
+                of its file (added without lines of text)."""
+        stamp, (filepath, tabsize), position = state
+        fileid = position >> self.file_shift
+        if (stamp != self.stamp or fileid >= len(self.files)
+                or self.files[fileid] != (filepath, tabsize)):
+            fileid = self.file_id(filepath, None, tabsize)
+            position = fileid << self.file_shift | position & ((1 << self.file_shift) - 1)
+        return position
+
+    def position(self, location, column=None, tabsize=0):
+        """ Return packed position of Location, with column (if given) and tabsize."""
+        fileid = self.file_id(location.filepath, location.lines, tabsize)
+        if column is None:
+            column = location.column
+        return self.pack(fileid, location.linenum, location.level, column)
+
+    def location(self, position):
+        """ Return Location built from packed position."""
+        fileid, linenum, level, column = self.unpack(position)
+        filepath, tabsize = self.files[fileid]
+        lines = self.lines.get(fileid, (None,))[0]
+        location = Location(filepath, lines, linenum, level, column)
+        location.tabsize = tabsize
+        return location
+
+
+locations = LocationTable()     # registry of files for all packed locations
+
+
 class Error(Exception):
     """ Convenient error reporting."""
     
@@ -74,6 +209,268 @@ class Error(Exception):
         return self.message
 
 
+class MappedLines(object):
+    """ Sequence of lines of text of a file (without line end chars, as by splitlines),
+            served from a read-only memory mapping of the file.
+        Only the offset of the start of each line is kept;
+            the text of a line is copied from the mapping when it is indexed.
+        Before the mapping is read, the file is checked to be unchanged (see map):
+            reading a mapping of a file truncated in place would crash the process.
+        close() unmaps the file (e.g. when evicted from a cache); it is mapped again
+            if lines are read later.
+    """
+    line_end = re.compile(r'\r\n?|\n')
+    block_size = 4096                   # lines copied at a time when iterating
+
+    def __init__(self, filepath):
+        """ Map the file at filepath (raise IOError if it cannot be read),
+            find the start of each line."""
+        self.filepath = filepath
+        self.mapfile = open(filepath, 'rb')
+        self.mapping = None
+        self.version = None             # (mtime, size) of file when lines were found
+        mapping = self.map()
+        self.size = self.version[1]
+        typecode = 'I' if self.size < 2 ** 32 else 'L'
+        self.starts = array(typecode)           # starts[i] is offset of line i (0-origin)
+        if mapping:
+            self.starts.append(0)
+            self.starts.extend(match.end() for match in self.line_end.finditer(mapping))
+            if self.starts[-1] == self.size:    # no line after last line end
+                self.starts.pop()
+
+    def map(self):
+        """ Return memory mapping of file (None if file is empty), mapping it again
+                if it was closed; raise Error if the file's modification time or size
+                has changed since its lines were found."""
+        if self.mapfile is None:
+            try:
+                self.mapfile = open(self.filepath, 'rb')
+            except (IOError, OSError) as exc:
+                raise Error('Error reading file ' + self.filepath, extra=str(exc))
+        stat = os.fstat(self.mapfile.fileno())
+        version = (stat.st_mtime, stat.st_size)
+        if self.version is None:
+            self.version = version
+        elif version != self.version:
+            self.close()
+            raise Error('File changed after it was read: ' + self.filepath)
+        if self.mapping is None and self.version[1]:    # can't map an empty file
+            self.mapping = mmap.mmap(self.mapfile.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapping
+
+    def close(self):
+        """ Unmap and close the file (lines read later map it again)."""
+        if self.mapping:
+            self.mapping.close()
+            self.mapping = None
+        if self.mapfile:
+            self.mapfile.close()
+            self.mapfile = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        """ Return text of line at index, or list of lines of slice."""
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self.starts)))]
+        if index < 0:
+            index += len(self.starts)
+        start = self.starts[index]          # raises IndexError if out of range
+        end = self.starts[index + 1] if index + 1 < len(self.starts) else self.size
+        text = self.map()[start:end]
+        if text.endswith('\r\n'):
+            return text[:-2]
+        elif text.endswith(('\n', '\r')):
+            return text[:-1]
+        return text
+
+    def __iter__(self):
+        """ Generator of lines; copies a block of lines at a time from the mapping."""
+        starts = self.starts
+        for first in xrange(0, len(starts), self.block_size):
+            last = first + self.block_size
+            end = starts[last] if last < len(starts) else self.size
+            for line in self.map()[starts[first]:end].splitlines():
+                yield line
+
+
+class CompressedLines(object):
+    """ Sequence of lines of text of a compressed file (gzip, bzip2 or xz, by suffix),
+            without line end chars (as by splitlines), decompressed as they are read.
+        Lines are not kept: indexing a line (e.g. to show it in an error message)
+            decompresses the file again, up to that line.
+    """
+    def __init__(self, filepath):
+        """ Check that file at filepath can be opened (raise IOError if not)."""
+        self.filepath = filepath
+        self.length = None          # number of lines, counted when needed
+        suffix = os.path.splitext(filepath)[1]
+        if suffix == '.gz':
+            self.opener = gzip.open
+        elif suffix == '.bz2':
+            self.opener = bz2.BZ2File
+        elif lzma:
+            self.opener = lzma.open
+        else:
+            raise IOError('Reading xz compressed files requires module lzma '
+                            '(Python 3) or backports.lzma')
+        self.open().close()
+
+    def open(self):
+        return self.opener(self.filepath, 'rb')
+
+    def __iter__(self):
+        try:
+            with closing(self.open()) as textfile:
+                for text in textfile:
+                    for line in text.splitlines():
+                        yield line
+        except (IOError, EOFError) as exc:
+            raise Error('Error decompressing file ' + self.filepath, extra=str(exc))
+
+    def __nonzero__(self):
+        return True                 # (without counting lines)
+
+    def __len__(self):
+        if self.length is None:
+            self.length = sum(1 for line in self)
+        return self.length
+
+    def __getitem__(self, index):
+        """ Return text of line at index, or list of lines of slice."""
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if index >= 0:
+            for line in islice(self, index, None):
+                return line
+        raise IndexError('Line index out of range')
+
+
+class TextLines(object):
+    """ Sequence of lines of text (without line end chars) from a string (split as by
+            splitlines), or from an iterable of lines (such as a file object),
+            read as needed. Lines read are kept, so they can be indexed.
+    """
+    def __init__(self, source):
+        if isinstance(source, basestring):
+            self.lines = source.splitlines()
+            self.source = None
+        else:
+            self.lines = []
+            self.source = iter(source)      # lines not yet read
+
+    def read(self):
+        """ Read one more line from source; return False if none."""
+        for line in self.source or ():
+            if line.endswith('\r\n'):
+                line = line[:-2]
+            elif line.endswith(('\n', '\r')):
+                line = line[:-1]
+            self.lines.append(line)
+            return True
+        self.source = None
+        return False
+
+    def __iter__(self):
+        index = 0
+        while index < len(self.lines) or self.read():
+            yield self.lines[index]
+            index += 1
+
+    def __nonzero__(self):
+        return True                 # (without reading lines)
+
+    def __len__(self):
+        while self.read():
+            pass
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        """ Return text of line at index, or list of lines of slice."""
+        if isinstance(index, slice) or index < 0:
+            len(self)               # read all lines
+        else:
+            while index >= len(self.lines) and self.read():
+                pass
+        return self.lines[index]
+
+
+def open_lines(filepath):
+    """ Return lines of text of file at filepath (raise IOError or OSError if not read):
+            CompressedLines if it has a compressed suffix, else MappedLines."""
+    if filepath.endswith(tuple(compressed_suffixes)):
+        return CompressedLines(filepath)
+    return MappedLines(filepath)
+
+
+def close_lines(lines):
+    """ Close lines if they keep a file open (see MappedLines.close)."""
+    if isinstance(lines, MappedLines):
+        lines.close()
+
+
+def find_file(filepath):
+    """ Return filepath if file exists, else path of a compressed file
+            (filepath + compressed suffix) if one exists, else filepath."""
+    if not os.path.exists(filepath):
+        for suffix in compressed_suffixes:
+            if os.path.exists(filepath + suffix):
+                return filepath + suffix
+    return filepath
+
+
+def uncompressed_path(filepath):
+    """ Return filepath without any compressed suffix."""
+    root, suffix = os.path.splitext(filepath)
+    return root if suffix in compressed_suffixes else filepath
+
+
+class FileCache(object):
+    """ Lines (see open_lines) of recently read files, shared by the parsers of a process.
+        An entry is reread if the modification time or size of its file has changed.
+        Least recently used entries are dropped (and closed, see close_lines)
+            when there are more than max_files.
+    """
+    max_files = 64
+
+    def __init__(self):
+        self.entries = OrderedDict()    # entries[abspath] is ((mtime, size), lines)
+        self.hits = 0                   # number of requests served from cache
+        self.misses = 0                 # number of files read
+
+    def lines(self, filepath):
+        """ Return MappedLines of file at filepath, from cache if file is unchanged;
+            raise IOError or OSError if file cannot be read."""
+        key = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        version = (stat.st_mtime, stat.st_size)
+        entry = self.entries.pop(key, None)         # reinserted below, as most recent
+        if entry and entry[0] == version:
+            self.hits += 1
+        else:
+            if entry:
+                close_lines(entry[1])
+            entry = (version, open_lines(filepath))
+            self.misses += 1
+        self.entries[key] = entry
+        while len(self.entries) > self.max_files:
+            close_lines(self.entries.popitem(last=False)[1][1])     # least recently used
+        return entry[1]
+
+    def clear(self):
+        for version, lines in self.entries.values():
+            close_lines(lines)
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+
+file_cache = FileCache()
+
+
 class LineParser(object):
     """ Serves lines of text from an iterator of strings; 
         implements an iterator; tracks line number."""
@@ -103,6 +500,15 @@ class LineParser(object):
             yield resulting lines. (Override in subclasses.)"""
         yield line
     
+    def readrange(self, start, end):
+        """ Generator of processed lines start + 1 through end (line numbers, 1-origin);
+            source must be a sequence of lines."""
+        self.location.linenum = start
+        for line in self.location.lines[start:end]:
+            self.location.linenum += 1
+            for procline in self.process_line(line):
+                yield procline
+    
     def readlines(self):
         """ Return list of remaining lines, each terminated with '\n'."""
         return ['%s\n' % line for line in self.generator()]
@@ -159,44 +565,62 @@ class IndentParser(LineParser):
 
 class FileParser(IndentParser):
     """ Serves lines of text from file; implements an iterator; 
-        tracks line number. Lines served without line end chars.
+        tracks line number. Lines served without line end chars,
+        read as needed from a memory mapping (self.location.lines is a MappedLines),
+        or from a compressed file (see find_file, CompressedLines).
         Option to track indentation (see IndentParser), disabled by default."""
     
-    def __init__(self, filepath, track_indent=False):
-        """ Create line parser from text file at filepath.
-            Option to track indentation (see IndentParser), disabled by default."""
+    def __init__(self, filepath, track_indent=False, cached=False):
+        """ Create line parser from text file at filepath, or at filepath
+                with a compressed suffix if there is no file at filepath.
+            Option to track indentation (see IndentParser), disabled by default.
+            If cached, lines are shared through file_cache."""
+        filepath = find_file(filepath)
         try:
-            filetext = open(filepath).read()
-        except IOError as exc:
+            lines = file_cache.lines(filepath) if cached else open_lines(filepath)
+        except (IOError, OSError) as exc:
             raise Error('Error loading file ' + filepath, extra=str(exc))
-        lines = filetext.splitlines()
         IndentParser.__init__(self, lines, track_indent)
         self.location.filepath = filepath
 
 
+class TextParser(IndentParser):
+    """ Serves lines of text from a string or iterable of lines (see TextLines);
+        implements an iterator; tracks line number. Lines served without line end chars.
+        filepath is a name for the text, used in locations (e.g. in error messages).
+        Option to track indentation (see IndentParser), disabled by default."""
+    
+    def __init__(self, source, filepath='<string>', track_indent=False):
+        IndentParser.__init__(self, TextLines(source), track_indent)
+        self.location.filepath = filepath
+
+
 class ImportParser(FileParser):
     """ Serves (linetext, location) from file; implements an iterator; tracks line number.
         Recursively includes other files as specified in import commands,
-            keeping a list of imports to avoid repeats and loops.
+            keeping a set of imports to avoid repeats and loops.
+        Lines of files are shared with other parsers through file_cache.
         Option to track indentation level."""
     
     def __init__(self, filepath, track_indent=False, imported=None):
         """ Create import parser from text file at filepath.
             Option to track indentation (see IndentParser), disabled by default.
-            Optional param 'imported' is a list of filepaths already imported.
+            Optional param 'imported' is a set of filepaths already imported.
         """
-        FileParser.__init__(self, filepath, track_indent)
+        FileParser.__init__(self, filepath, track_indent, cached=True)
+        filepath = self.location.filepath       # may have compressed suffix
         if imported == None:
-            imported = []
-        self.imported = imported                # list of already imported filepaths
-        self.imported.append(filepath)
+            imported = set()
+        self.imported = imported                # set of already imported filepaths
+        self.imported.add(filepath)
         self.directory = os.path.dirname(filepath)
-        self.extension = os.path.splitext(filepath)[1]
+        self.extension = os.path.splitext(uncompressed_path(filepath))[1]
 
     def process_line(self, line):
         """ Generator of processed lines. If a line begins <import_command> <import>,
             yield lines of file <import>.ext in place of this line, else yield line. 
-            Imported file uses directory and extension of parent file.
+            Imported file uses directory and extension of parent file
+                (it may be compressed, whether or not parent file is: see find_file).
             Yields (line, location); location is a Location object.
         """
         # overriding FileParser.process_line(), so do its processing first
@@ -206,6 +630,7 @@ class ImportParser(FileParser):
                 importname = command[len(import_command):].strip()
                 if importname.isalnum():        # if alphanumeric, include imported file
                     importpath = os.path.join(self.directory, importname) + self.extension
+                    importpath = find_file(importpath)
                     if importpath not in self.imported:
                         importer = ImportParser(importpath, self.track_indent, self.imported)
                         for import_line in importer:
@@ -219,7 +644,7 @@ class LineInfoParser(LineParser):
         Serves lines of text (without line end chars) from file; 
             implements an iterator; tracks line number.
         Recursively includes other files as specified in import commands,
-            keeping a list of imports to avoid repeats and loops.
+            keeping a set of imports to avoid repeats and loops.
         Option to track indentation level."""
     
     def __init__(self, filepath, track_indent=False):
@@ -231,7 +656,7 @@ class LineInfoParser(LineParser):
     def generator(self):
         """ Generator (iterator) of lines of file."""
         for line, location in self.parser:
-            self.location = location.copy()
+            self.location = location        # changes as lines are read: copy to keep
             yield line
 
 
@@ -3,6 +3,9 @@
 # Copyright 2013 by David H Post, DaviWorks.com.
 
 
+from lineparsers import locations
+
+
 indent_size = 3
 indent1 = ' ' * indent_size             # string to display one level of indentation
 indent2 = '|' + indent1[1:]             # every other indent contains a vertical bar
@@ -14,26 +17,62 @@ def new(name, debug_flags=''):
     return NonterminalNode(name, debug_flags)
 
 
+def indent(level, location=None):
+    """ Return string of indentation to level, after line and column numbers of
+        location if given."""
+    prefix = ''
+    if location:
+        prefix = '%2d %2d ' % (location.linenum, location.column)
+    return prefix + indentation[len(prefix):level * indent_size]
+
+
+def relocate(nodes, shift):
+    """ Add shift to line numbers of packed positions of nodes and their descendants
+        (e.g. after lines before them are added or removed, when source is edited)."""
+    offset = shift << (locations.level_bits + locations.column_bits)
+    nodes = list(nodes)
+    while nodes:
+        node = nodes.pop()
+        if node.position is not None:
+            node.position += offset
+        if not node.isterminal():
+            nodes.extend(node.children)
+
+
 class BaseNode:
     """ Base class for a node of the parse tree."""
     def __init__(self, name, debug_flags):
         self.name = name                # name of nonterminal or terminal
         self.debug = debug_flags
         self.level = 0                  # depth of node in tree
-        self.location = None            # (lineparsers.Location) where found in source text 
+        self.position = None            # packed location where found in source text 
         self.used = False               # to keep track of nodes already compiled
 
     def set_location(self, token):
         """ Set location in source code from token."""
-        if not self.location:       # set once only
-            self.location = token.location
+        if self.position is None:   # set once only
+            self.position = token.position
+
+    @property
+    def location(self):
+        """ lineparsers.Location where found in source text, built when needed."""
+        if self.position is not None:
+            return locations.location(self.position)
+
+    def __getstate__(self):
+        """ Pickle position as a state of its file and fields (see LocationTable.state)."""
+        if self.position is None:
+            return self.__dict__
+        return dict(self.__dict__, position=locations.state(self.position))
+
+    def __setstate__(self, state):
+        if state['position'] is not None:
+            state['position'] = locations.restore(state['position'])
+        self.__dict__.update(state)
 
     def indent(self):
         """ Return string of indentation to level of node."""
-        location = ''
-        if 'n' in self.debug:
-            location = '%2d %2d ' % (self.location.linenum, self.location.column)
-        return location + indentation[len(location):self.level * indent_size]
+        return indent(self.level, self.location if 'n' in self.debug else None)
 
     def find(self, name):
         """ Return self if name matches. Extended by subclass."""
@@ -79,7 +118,10 @@ class TerminalNode(BaseNode):
 
 
 class NonterminalNode(BaseNode):
-    """ A nonterminal node of the parse tree; contains a list of child nodes."""
+    """ A nonterminal node of the parse tree; contains a list of child nodes,
+        and comment tokens that follow the terminals of its syntax."""
+    comments = ()               # comment tokens, in order (see add_comments)
+    
     def __init__(self, name, debug_flags):
         BaseNode.__init__(self, name, debug_flags)
         self.children = []
@@ -106,23 +148,17 @@ class NonterminalNode(BaseNode):
         self.children.append(child)
         return child
         
-    def remove_child(self):
-        """ Remove last child."""
-        del self.children[-1]
-        
-    def remove_children(self, numchildren=None):
-        """ Remove first numchildren children, or all if number not given."""
-        del self.children[:numchildren]
-        
-    def keep_children(self, numchildren):
-        """ Keep first numchildren children, discard the rest."""
-        del self.children[numchildren:]
+    def add_comments(self, comments):
+        """ Append comment tokens to this node's comments."""
+        self.comments = self.comments + tuple(comments)
         
     def show(self):
         """ Return display (as string) of parse tree starting at this node."""
         result = self.indent() + self.name + '\n'
         for node in self.children:
             result += node.show()
+        for comment in self.comments:
+            result += indentation[:(self.level + 1) * indent_size] + str(comment) + '\n'
         return result
 
     def nextchild(self, name=None, use=True, loc=None):
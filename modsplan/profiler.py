@@ -0,0 +1,206 @@
+# profiler.py
+# Modsplan parse profiler
+# Copyright 2013- by David H Post, DaviWorks.com.
+
+
+""" Counts and times parses of each nonterm and alternate, from events of
+        a SyntaxParser's trace (ParseProfile is a tracing sink), to find
+        the productions that cause backtracking.
+    For each nonterm and alternate:
+        attempts        parses begun (a nonterm found in the memo is counted in memo)
+        successes       parses that succeeded, including those found in the memo
+                            (and the parses within them)
+        failures        parses that failed
+        discarded       successful parses not kept in the parse tree: an alternate
+                            not chosen, or a nonterm within a parse that failed
+                            or was discarded
+        tokens          tokens parsed by successful parses
+        backtracked     tokens parsed by failed or discarded parses,
+                            which the parser returns to and parses again
+        inclusive       time of parses, in seconds (of outermost parse, if recursive)
+        exclusive       time of parses, less the time of nonterm parses within them
+    Times include the cost of tracing, so compare them with each other only.
+"""
+
+import json
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+
+fields = ['attempts', 'successes', 'failures', 'discarded', 'memo',
+            'tokens', 'backtracked', 'inclusive', 'exclusive']
+
+
+class Activation:
+    """ Parse of a nonterm in progress (between its open and close events)."""
+    def __init__(self, name, time):
+        self.name = name
+        self.time = time            # time parse began
+        self.child_time = 0.0       # inclusive time of nonterm parses within this one
+        self.alt_time = 0.0         # time alternate began
+        self.alt_child_time = 0.0   # child_time when alternate began
+        self.parses = []            # parses of nonterms within the current alternate
+        self.successes = []         # (alternate, numtokens, parses) of successful alternates
+
+
+class ParseProfile(object):
+    """ Tracing sink that counts and times parses of nonterms and alternates.
+        A parse of a nonterm is kept as (name, numtokens, parses of nonterms within it)
+            until the alternate containing it ends: if that fails, or is not chosen,
+            the parse and those within it are counted as discarded.
+    """
+    def __init__(self):
+        self.nonterms = OrderedDict()   # nonterms[name] is dict of counts (see fields)
+        self.alternates = OrderedDict() # alternates[alternate] is dict of counts
+        self.names = {}                 # names[alternate] is 'nonterm => alternate'
+        self.active = {}                # active[name] is number of parses of nonterm
+                                        #   in progress (for inclusive time of recursion)
+        self.stack = [Activation(None, timer())]    # parses in progress
+        self.parsed = {}                # parsed[(name, position)] is parses within
+                                        #   successful parse of nonterm at token position
+
+    def counts(self, table, key):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = OrderedDict((field, 0) for field in fields)
+            entry['inclusive'] = entry['exclusive'] = 0.0
+        return entry
+
+    def emit(self, event):
+        kind = event.kind
+        if kind == 'open':
+            self.open(event.args[0], timer())
+        elif kind == 'alternate':
+            self.begin_alt(event.args[1], timer())
+        elif kind == 'end':
+            nonterm, alt, failure, numtokens = event.args
+            self.end_alt(nonterm, alt, failure, numtokens, timer())
+        elif kind == 'close':
+            nonterm, choice, failure, numtokens = event.args
+            self.close(choice, failure, numtokens, event.position, timer())
+        elif kind == 'memo':
+            nonterm, numtokens, failure = event.args
+            self.reuse(nonterm.name, failure, numtokens, event.position)
+        elif kind == 'begin':
+            self.stack = [Activation(None, timer())]
+            self.active = {}
+            self.parsed = {}
+
+    def open(self, nonterm, time):
+        self.counts(self.nonterms, nonterm.name)['attempts'] += 1
+        self.active[nonterm.name] = self.active.get(nonterm.name, 0) + 1
+        self.stack.append(Activation(nonterm.name, time))
+
+    def begin_alt(self, alt, time):
+        activation = self.stack[-1]
+        activation.alt_time = time
+        activation.alt_child_time = activation.child_time
+        activation.parses = []
+
+    def end_alt(self, nonterm, alt, failure, numtokens, time):
+        activation = self.stack[-1]
+        if alt not in self.names:
+            self.names[alt] = '%s => %s' % (nonterm, alt)
+        counts = self.counts(self.alternates, alt)
+        counts['attempts'] += 1
+        inclusive = time - activation.alt_time
+        counts['exclusive'] += inclusive - (activation.child_time - activation.alt_child_time)
+        if self.active[nonterm.name] == 1:
+            counts['inclusive'] += inclusive
+        if failure:
+            counts['failures'] += 1
+            counts['backtracked'] += numtokens
+            self.discard(activation.parses)
+        else:
+            counts['successes'] += 1
+            counts['tokens'] += numtokens
+            activation.successes.append((alt, numtokens, activation.parses))
+        activation.parses = []
+
+    def close(self, choice, failure, numtokens, position, time):
+        activation = self.stack.pop()
+        name = activation.name
+        counts = self.counts(self.nonterms, name)
+        inclusive = time - activation.time
+        counts['exclusive'] += inclusive - activation.child_time
+        self.active[name] -= 1
+        if not self.active[name]:
+            counts['inclusive'] += inclusive
+        parent = self.stack[-1]
+        parent.child_time += inclusive
+
+        kept = []       # parses of nonterms within alternate chosen
+        for alt, alt_tokens, parses in activation.successes:
+            if alt is choice and not failure:
+                kept = parses
+            else:
+                alt_counts = self.alternates[alt]
+                alt_counts['discarded'] += 1
+                alt_counts['backtracked'] += alt_tokens
+                self.discard(parses)
+        if failure:
+            counts['failures'] += 1
+            counts['backtracked'] += numtokens
+        else:
+            counts['successes'] += 1
+            counts['tokens'] += numtokens
+            parent.parses.append((name, numtokens, kept))
+            self.parsed[(name, position)] = kept
+
+    def reuse(self, name, failure, numtokens, position):
+        """ Count parse of nonterm at token position found in the memo; if it succeeded,
+            it is kept (or discarded) with the alternate containing it, as a parse is,
+            and so are the parses within it: they are counted as successes again."""
+        self.counts(self.nonterms, name)['memo'] += 1
+        if not failure:
+            parse = (name, numtokens, self.parsed.get((name, position), []))
+            self.stack[-1].parses.append(parse)
+            parses = [parse]
+            while parses:
+                name, numtokens, within = parses.pop()
+                counts = self.nonterms[name]
+                counts['successes'] += 1
+                counts['tokens'] += numtokens
+                parses.extend(within)
+
+    def discard(self, parses):
+        """ Count parses, and parses of nonterms within them, as discarded."""
+        parses = list(parses)
+        while parses:
+            name, numtokens, within = parses.pop()
+            counts = self.nonterms[name]
+            counts['discarded'] += 1
+            counts['backtracked'] += numtokens
+            parses.extend(within)
+
+    def report(self, key='exclusive'):
+        """ Return dict of counts of nonterms and of alternates, each sorted by key
+            (greatest first)."""
+        order = lambda (name, counts): (-counts[key], name)
+        nonterms = sorted(self.nonterms.items(), key=order)
+        alternates = sorted(((self.names[alt], counts)
+                                for alt, counts in self.alternates.items()), key=order)
+        return OrderedDict([('nonterms', OrderedDict(nonterms)),
+                            ('alternates', OrderedDict(alternates))])
+
+    def json(self, key='exclusive'):
+        """ Return report as JSON text."""
+        return json.dumps(self.report(key), indent=2)
+
+    def table(self, key='exclusive', limit=20):
+        """ Return report as text table: the first limit nonterms and alternates
+            (all if limit is None), sorted by key."""
+        report = self.report(key)
+        heading = '%-40s' + ' %11s' * 7 + ' %10s %10s\n'
+        line = '%-40s' + ' %11d' * 7 + ' %10.1f %10.1f\n'
+        text = ''
+        for title in ('nonterms', 'alternates'):
+            text += '\nParse costs by %s (sorted by %s):\n' % (title[:-1], key)
+            text += heading % tuple([title[:-1]] + fields[:-2] + ['incl (ms)', 'excl (ms)'])
+            for name, counts in report[title].items()[:limit]:
+                if len(name) > 40:
+                    name = name[:37] + '...'
+                values = [counts[field] for field in fields]
+                values[-2:] = [counts['inclusive'] * 1000, counts['exclusive'] * 1000]
+                text += line % tuple([name] + values)
+        return text
@@ -0,0 +1,285 @@
+# scanner.py
+# Modsplan table-driven token scanner
+# Copyright 2013- by David H Post, DaviWorks.com.
+
+
+""" Compiles a token grammar into a deterministic finite automaton (DFA).
+    The DFA finds the longest token at a column in one pass over the chars,
+        instead of matching each possible token kind in turn.
+
+    Construction:
+        Each token kind becomes a nondeterministic automaton (NFA),
+            built from its productions (character classes, literals, quantifiers).
+        The NFAs are combined and determinized by subset construction.
+        Chars are grouped into columns of the transition table:
+            each char used in a literal has its own column,
+            other chars share a column for their character class (L, U, D, or other).
+
+    A DFA state accepts the kind that appears first in the token grammar,
+        among the kinds that accept there, so ties go to the earlier kind
+        (as in Tokenizer.match_token).
+    'P* literal' matches up to the first occurrence of the literal;
+        a P* at the end of a production matches the rest of the line.
+
+    Items are matched as regular expressions, so an item may match fewer chars
+        than it could, when that lets the rest of a production match
+        (Tokenizer.match_nonterm always matches as many chars as it can).
+
+    Grammars with recursive nonterms or separators cannot be compiled (Unsupported).
+"""
+
+import tokenize
+
+
+class Unsupported(Exception):
+    """ Token grammar uses a feature the DFA cannot represent."""
+    pass
+
+
+class NFA:
+    """ Nondeterministic automaton: numbered states, with labelled and empty edges.
+        An edge label is one of:
+            ('c', char)     matches char
+            ('k', class)    matches any char of character class L, U or D
+            ('a',)          matches any char
+            ('x', chars)    matches any char not in chars
+    """
+    def __init__(self, tokendef):
+        self.tokendef = tokendef
+        self.edges = []         # edges[state] is list of (label, target state)
+        self.empty = []         # empty[state] is list of target states of empty edges
+        self.accepts = {}       # accepts[state] is kind accepted at state
+        self.starts = {}        # starts[kindname] is start state for kind
+        self.expanding = []     # names of nonterms being expanded (to detect recursion)
+        for kind in tokendef.kinds:
+            start, end = self.nonterm(kind)
+            self.starts[kind.name] = start
+            self.accepts[end] = kind
+
+    def new_state(self):
+        self.edges.append([])
+        self.empty.append([])
+        return len(self.edges) - 1
+
+    def fragment(self, label=None):
+        """ Return (start, end) of new fragment: an edge with label, or empty edge."""
+        start, end = self.new_state(), self.new_state()
+        if label:
+            self.edges[start].append((label, end))
+        else:
+            self.empty[start].append(end)
+        return start, end
+
+    def nonterm(self, nonterm):
+        """ Return (start, end) of fragment matching any alternate of nonterm."""
+        if nonterm.name in self.expanding:
+            raise Unsupported('Recursive nonterm (%s)' % nonterm.name)
+        self.expanding.append(nonterm.name)
+        start, end = self.new_state(), self.new_state()
+        for alt in nonterm.alternates:
+            altstart, altend = self.alternate(alt)
+            self.empty[start].append(altstart)
+            self.empty[altend].append(end)
+        self.expanding.pop()
+        return start, end
+
+    def alternate(self, alt):
+        """ Return (start, end) of fragment matching sequence of items of alternate."""
+        start = end = self.new_state()
+        items = list(alt.items)
+        while items:
+            item = items.pop(0)
+            if item.ischarclass() and item.text() == 'P':       # assumes P*
+                if items:
+                    itemstart, itemend = self.skip_to(items.pop(0))
+                else:
+                    itemstart, itemend = self.fragment(('a',))  # rest of line
+                    self.empty[itemend].append(itemstart)
+                    self.empty[itemstart].append(itemend)
+            else:
+                itemstart, itemend = self.quantified(item)
+            self.empty[end].append(itemstart)
+            end = itemend
+        return start, end
+
+    def skip_to(self, item):
+        """ Return (start, end) of fragment matching any chars
+            through first occurrence of literal item (follows P*)."""
+        if not item.isliteral() or item.quantifier != '1':
+            raise Unsupported('P* must be followed by a literal without quantifier')
+        literal = item.text()
+        states = [self.new_state() for char in literal]
+        end = self.new_state()
+        chars = set(literal)
+        for matched, state in enumerate(states):
+            # Knuth-Morris-Pratt: on each char, go to longest prefix of literal matched
+            for char in chars:
+                seen = literal[:matched] + char
+                length = len(seen)
+                while not literal.startswith(seen[len(seen) - length:]):
+                    length -= 1
+                target = end if length == len(literal) else states[length]
+                self.edges[state].append((('c', char), target))
+            self.edges[state].append((('x', chars), states[0]))
+        return states[0], end
+
+    def quantified(self, item):
+        """ Return (start, end) of fragment matching item, with its quantifier."""
+        if item.separator:
+            raise Unsupported('Separator in token grammar (%s)' % item)
+        start, end = self.single(item)
+        if item.quantifier in '?*':
+            self.empty[start].append(end)       # zero occurrences
+        if item.quantifier in '*+':
+            self.empty[end].append(start)       # repeat
+        return start, end
+
+    def single(self, item):
+        """ Return (start, end) of fragment matching one occurrence of item."""
+        item_text = item.text()
+        if item.ischarclass():
+            return self.fragment(('k', item_text))
+        elif item.isliteral():
+            start = end = self.new_state()
+            for char in item_text:
+                nextstate = self.new_state()
+                self.edges[end].append((('c', char), nextstate))
+                end = nextstate
+            return start, end
+        else:   # item must be a nonterminal
+            return self.nonterm(self.tokendef.nonterms[item_text])
+
+    def closure(self, states):
+        """ Return frozenset of states reachable from states by empty edges."""
+        result = set(states)
+        stack = list(states)
+        while stack:
+            for target in self.empty[stack.pop()]:
+                if target not in result:
+                    result.add(target)
+                    stack.append(target)
+        return frozenset(result)
+
+    def move(self, states, column):
+        """ Return set of states reached from states on a char of column
+            (see label_matches)."""
+        result = set()
+        for state in states:
+            for label, target in self.edges[state]:
+                if label_matches(label, column):
+                    result.add(target)
+        return result
+
+
+def label_matches(label, column):
+    """ Does edge label match the chars of column?
+        A column is ('c', char) for a literal char, ('k', class) for other chars
+            of character class L, U or D, or ('o',) for all other chars."""
+    kind = label[0]
+    if kind == 'a':
+        return True
+    elif kind == 'x':
+        return column[0] != 'c' or column[1] not in label[1]
+    elif column[0] == 'c':
+        if kind == 'c':
+            return label[1] == column[1]
+        return label[1] == tokenize.charclass(column[1])
+    else:
+        return kind == 'k' and column == label
+
+
+class DFAScanner:
+    """ Finds longest token at a column, using transition table compiled from grammar."""
+
+    def __init__(self, tokendef):
+        """ Compile TokenGrammar tokendef; raise Unsupported if not possible."""
+        nfa = NFA(tokendef)
+        order = dict((kind.name, index) for index, kind in enumerate(tokendef.kinds))
+
+        # Columns of transition table: literal chars, then character classes
+        literal_chars = set()
+        for nonterm in tokendef.nonterms.values():
+            for alt in nonterm.alternates:
+                for item in alt.items:
+                    if item.isliteral():
+                        literal_chars.update(item.text())
+        self.columns = [('c', char) for char in sorted(literal_chars)]
+        self.columns += [('k', 'L'), ('k', 'U'), ('k', 'D'), ('o',)]
+        self.column_index = dict((column, index) for index, column in enumerate(self.columns))
+        self.char_columns = {}      # cache: char => column index
+
+        # Start state: kinds possible for the character class of first char
+        self.table = [[-1] * len(self.columns)]     # table[state][column] => next state
+        self.accept = ['']                          # accept[state] => kindname or ''
+        statenum = {}                               # NFA state set => DFA state number
+        pending = []                                # DFA states with rows to compute
+
+        def state_for(nfa_states):
+            """ Return DFA state number for set of NFA states, adding it if new."""
+            nfa_states = nfa.closure(nfa_states)
+            if not nfa_states:
+                return -1
+            if nfa_states not in statenum:
+                statenum[nfa_states] = len(self.table)
+                self.table.append([-1] * len(self.columns))
+                kinds = [nfa.accepts[state] for state in nfa_states if state in nfa.accepts]
+                kinds.sort(key=lambda kind: order[kind.name])
+                self.accept.append(kinds[0].name if kinds else '')
+                pending.append(nfa_states)
+            return statenum[nfa_states]
+
+        for index, column in enumerate(self.columns):
+            if column[0] == 'c':
+                chrclass = tokenize.charclass(column[1])
+            else:
+                chrclass = column[-1]       # 'o' is not a key of prefix_map
+            kinds = tokendef.prefix_map.get(chrclass, [])
+            starts = nfa.closure([nfa.starts[kind.name] for kind in kinds])
+            self.table[0][index] = state_for(nfa.move(starts, column))
+
+        while pending:
+            nfa_states = pending.pop()
+            row = self.table[statenum[nfa_states]]
+            for index, column in enumerate(self.columns):
+                row[index] = state_for(nfa.move(nfa_states, column))
+
+
+    def column_of(self, char):
+        """ Return index of transition table column for char."""
+        index = self.char_columns.get(char)
+        if index is None:
+            index = self.column_index.get(('c', char))
+            if index is None:
+                chrclass = tokenize.charclass(char)
+                column = ('k', chrclass) if chrclass in ('L', 'U', 'D') else ('o',)
+                index = self.column_index[column]
+            self.char_columns[char] = index
+        return index
+
+
+    def match(self, line, col):
+        """ Find longest token at line[col]; return (length, kindname), (0, '') if none."""
+        table = self.table
+        accept = self.accept
+        columns = self.char_columns
+        state = 0
+        maxlength = 0
+        kindname = ''
+        index = col
+        end = len(line)
+        while index < end:
+            char = line[index]
+            column = columns.get(char)
+            if column is None:
+                column = self.column_of(char)
+            state = table[state][column]
+            if state < 0:
+                break
+            index += 1
+            if accept[state]:
+                maxlength = index - col
+                kindname = accept[state]
+        return maxlength, kindname
+
+    def numstates(self):
+        return len(self.table)
@@ -7,11 +7,22 @@
 
 import sys
 import os.path
+import bisect
+import multiprocessing
+from array import array
 
 import grammar
 import tokenize
 import parsetree
-from lineparsers import Error
+import profiler
+import tracing
+from lineparsers import Error, locations, uncompressed_path
+
+
+# Bracket pairs: punctuation text, or token kind name (for INDENT and DEDENT)
+bracket_pairs = [('(', ')'), ('[', ']'), ('{', '}'), ('INDENT', 'DEDENT')]
+
+lookahead_depth = 2         # number of tokens used to choose alternates (see find_lookahead)
 
 
 class SyntaxGrammar(grammar.Grammar):
@@ -27,6 +38,215 @@ class SyntaxGrammar(grammar.Grammar):
         # find prefixes for all nonterms and alternates
         for nonterm in self.nonterms.values():
             nonterm.find_prefixes(self.nonterms)
+        self.literal_bits = {}      # literal_bits[text] is bit of literal in prefix masks
+        self.kind_bits = {}         # kind_bits[name] is bit of token kind in prefix masks
+        self.suffix_masks = {}      # suffix_masks[name] is bits of terminals that may end
+                                    #   a parse of nonterm name
+        self.find_prefix_masks()
+        self.bracket_pairs = []     # bracket pairs balanced in every alternate
+        self.conflicts = []         # nonterms not told apart by lookahead (see find_lookahead)
+        # item of root repeated (without separator), if its occurrences can be
+        #   reparsed separately after an edit (see SyntaxParser.reparse), else None
+        self.repeated = None
+        alternates = self.root.alternates
+        if len(alternates) == 1 and len(alternates[0].items) == 1:
+            item = alternates[0].items[0]
+            if not item.isterminal() and item.quantifier in '+*' and not item.separator:
+                self.repeated = item
+
+    def find_prefix_masks(self):
+        """ Give each terminal a bit, and compute prefix_mask of each nonterm and
+                alternate: bits of terminals that may begin a parse (as prefixes, but
+                a literal and a token kind of the same text have different bits).
+            Bit 1 is '' (empty parse): matched by a token with empty text or kind name.
+            Also compute suffix masks of nonterms (in self.suffix_masks).
+        """
+        self.literal_bits = {'': 1}
+        self.kind_bits = {'': 1}
+        masks = self.grow_masks()
+        for name, nonterm in self.nonterms.items():
+            nonterm.prefix_mask = masks[name]
+            for alt in nonterm.alternates:
+                alt.prefix_mask = self.sequence_mask(alt.items, masks)
+        self.suffix_masks = self.grow_masks(reverse=True)
+
+    def grow_masks(self, reverse=False):
+        """ Return masks[name] for each nonterm: bits of terminals that may begin
+            a parse of it (if reverse, that may end one), grown to a fixed point."""
+        masks = dict((name, 0) for name in self.nonterms)
+        changed = True
+        while changed:
+            changed = False
+            for name, nonterm in self.nonterms.items():
+                mask = 0
+                for alt in nonterm.alternates:
+                    items = alt.items[::-1] if reverse else alt.items
+                    mask |= self.sequence_mask(items, masks)
+                if mask != masks[name]:
+                    masks[name] = mask
+                    changed = True
+        return masks
+
+    def sequence_mask(self, items, masks):
+        """ Return bits of terminals that may begin a parse of items (list of Item),
+            given masks[name] for each nonterm."""
+        mask = 0
+        for item in items:
+            if item.isterminal():
+                bits = self.literal_bits if item.isliteral() else self.kind_bits
+                item_mask = bits.get(item.text())
+                if item_mask is None:
+                    # next bit ('' is in both tables)
+                    item_mask = bits[item.text()] = 1 << (len(self.literal_bits) +
+                                                            len(self.kind_bits) - 1)
+            else:
+                item_mask = masks[item.text()]
+            mask |= item_mask
+            if item_mask & 1:
+                continue    # item can be empty, so may be more prefixes
+            if item.quantifier not in '?*':
+                return mask # item cannot occur 0 times, so no more first terminals
+        return mask | 1     # production may produce nothing
+
+    def token_mask(self, token):
+        """ Return prefix mask bits of terminals token matches: its text as a literal,
+            and its kind name."""
+        return self.literal_bits.get(token.text, 0) | self.kind_bits.get(token.name, 0)
+
+    def find_brackets(self, pairs):
+        """ Find which bracket pairs are balanced in every alternate
+                (each opening bracket item followed by its closing bracket item,
+                with no quantifier or separator), save them in self.bracket_pairs.
+            Compute brackets required by each alternate (in alt.required).
+        """
+        self.bracket_pairs = [pair for pair in pairs if self.balanced(pair)]
+        keys = set(key for pair in self.bracket_pairs for key in pair)
+        alternates = [alt for nonterm in self.nonterms.values() for alt in nonterm.alternates]
+        for alt in alternates:
+            alt.required = frozenset()
+        # required brackets of nonterms, grown to a fixed point
+        required = dict((name, frozenset()) for name in self.nonterms)
+        changed = True
+        while changed:
+            changed = False
+            for alt in alternates:
+                brackets = set()
+                for item in alt.items:
+                    if item.quantifier in '1+':
+                        if item.isterminal():
+                            if item.text() in keys:
+                                brackets.add(item.text())
+                        else:
+                            brackets |= required[item.text()]
+                alt.required = frozenset(brackets)
+            for name, nonterm in self.nonterms.items():
+                brackets = frozenset.intersection(*[alt.required
+                                                    for alt in nonterm.alternates])
+                if brackets != required[name]:
+                    required[name] = brackets
+                    changed = True
+
+    def find_lookahead(self, depth, kind_of):
+        """ Find sequences of up to depth terminals that may begin a parse of each
+                alternate (a shorter sequence is a whole parse), saved in alt.lookahead.
+            Build a trie of those sequences for each nonterm (nonterm.dispatch, see
+                dispatch_trie); alt.mask is the bit of alt in masks of the trie.
+            Save in self.conflicts the names of nonterms for which the next depth tokens
+                may not select only one alternate (kind_of(text) is token kind of text).
+        """
+        first = dict((name, set()) for name in self.nonterms)
+        changed = True
+        while changed:              # grow sequences to a fixed point
+            changed = False
+            for name, nonterm in self.nonterms.items():
+                for alt in nonterm.alternates:
+                    sequences = set([()])
+                    for item in alt.items:
+                        sequences = concatenate(sequences,
+                                                self.item_sequences(item, first, depth), depth)
+                    alt.lookahead = sequences
+                    if not sequences <= first[name]:
+                        first[name] |= sequences
+                        changed = True
+        self.conflicts = []
+        for name, nonterm in self.nonterms.items():
+            for index, alt in enumerate(nonterm.alternates):
+                alt.mask = 1 << index
+            nonterm.dispatch = dispatch_trie(nonterm.alternates)
+            if self.conflicted([nonterm.dispatch], nonterm.dispatch[0], depth, kind_of):
+                self.conflicts.append(name)
+
+    def item_sequences(self, item, first, depth):
+        """ Return set of sequences of up to depth terminals that may begin a parse of
+            item (with its quantifier), given first[name] for each nonterm."""
+        if item.isterminal():
+            sequences = set([(item.text(),)])
+        else:
+            sequences = first[item.text()]
+        if item.quantifier in '+*':
+            step = sequences
+            if item.separator:
+                step = concatenate(set([(item.separator,)]), sequences, depth)
+            repeated = set(sequences)
+            while True:
+                more = repeated | concatenate(repeated, step, depth)
+                if item.separator:  # parse_alt keeps a separator not followed by an item
+                    more |= concatenate(repeated, set([(item.separator,)]), depth)
+                if more == repeated:
+                    break
+                repeated = more
+            sequences = repeated
+        if item.quantifier in '?*':
+            sequences = sequences | set([()])
+        return sequences
+
+    def conflicted(self, nodes, mask, depth, kind_of):
+        """ Can tokens matching paths from trie nodes select more than one alternate
+                (mask has bits of alternates already selected)?
+            A token matches by its text or its kind (see SyntaxParser.lookahead).
+        """
+        if mask & (mask - 1):
+            return True             # more than one bit set
+        if depth == 0:
+            return False
+        tokens = set()              # (kind, text) of tokens matching children of nodes
+        for node in nodes:
+            for terminal in node[1]:
+                if terminal in self.tokenkindnames:
+                    tokens.add((terminal, None))
+                else:
+                    tokens.add((kind_of(terminal), terminal))
+        for kind, text in tokens:
+            children = [node[1][terminal] for node in nodes for terminal in (text, kind)
+                            if terminal in node[1]]
+            childmask = mask
+            for child in children:
+                childmask |= child[0]
+            if self.conflicted(children, childmask, depth - 1, kind_of):
+                return True
+        return False
+
+    def balanced(self, pair):
+        """ Is bracket pair balanced in every alternate?"""
+        opening, closing = pair
+        for nonterm in self.nonterms.values():
+            for alt in nonterm.alternates:
+                depth = 0
+                for item in alt.items:
+                    key = item.text() if item.isterminal() else ''
+                    if item.separator in pair:
+                        return False
+                    if key in pair and item.quantifier != '1':
+                        return False
+                    if key == opening:
+                        depth += 1
+                    elif key == closing:
+                        if depth == 0:
+                            return False
+                        depth -= 1
+                if depth:
+                    return False
+        return True
 
     def check_item(self, item, quantifier, alt):
         """ Check string item, with given quantifier, in alternate alt."""
@@ -36,10 +256,338 @@ class SyntaxGrammar(grammar.Grammar):
             grammar.Grammar.check_item(self, item, quantifier, alt)
 
 
+def concatenate(first, second, depth):
+    """ Return set of sequences of each of set first followed by each of set second,
+        truncated to depth."""
+    result = set()
+    for head in first:
+        if len(head) >= depth:
+            result.add(head)
+        else:
+            for tail in second:
+                result.add((head + tail)[:depth])
+    return result
+
+
+def dispatch_trie(alternates):
+    """ Return trie of lookahead sequences of alternates: a node is [mask, children],
+            mask has bits (alt.mask) of alternates with a sequence ending at the node,
+            children[terminal] is node after terminal (literal text or token kind).
+    """
+    root = [0, {}]
+    for alt in alternates:
+        for sequence in alt.lookahead:
+            node = root
+            for terminal in sequence:
+                node = node[1].setdefault(terminal, [0, {}])
+            node[0] |= alt.mask
+    return root
+
+
+class BracketIndex:
+    """ Index of bracketed regions of a sequence of tokens, from one pass over them.
+        A region is a bracket pair (such as parentheses, or INDENT and DEDENT)
+            and the tokens between them.
+        If the grammar is balanced for these pairs, a parse starting at a token
+            matches only tokens before the end of the innermost region containing it.
+    """
+    def __init__(self, tokens, pairs):
+        """ Index tokens (list of Token or TokenStream) for bracket pairs
+                (list of (opening, closing) text, or kind name for named tokens).
+            If brackets of tokens are not balanced, self.balanced is False.
+        """
+        if isinstance(tokens, tokenize.TokenStream):
+            keys = [name or text for name, text in zip(tokens.kindnames(),
+                                                         tokens.tokentexts())]
+        else:
+            keys = [token.name or token.text for token in tokens]
+        closing_of = dict(pairs)
+        opening_of = dict((closing, opening) for opening, closing in pairs)
+        self.match = {}             # match[index] is index of matching bracket
+        self.positions = dict((key, []) for pair in pairs for key in pair)
+            # positions[key] is list of indices of bracket tokens with key
+        self.balanced = True
+        stack = []                  # indices of open brackets
+        for index, key in enumerate(keys):
+            if key in closing_of:
+                stack.append(index)
+            elif key in opening_of:
+                if not stack or keys[stack[-1]] != opening_of[key]:
+                    self.balanced = False
+                    break
+                opening = stack.pop()
+                self.match[opening] = index
+                self.match[index] = opening
+            else:
+                continue
+            self.positions[key].append(index)
+        if stack:
+            self.balanced = False
+        
+        # region_end[index] is index of closing bracket of innermost region containing
+        #   token at index (not counting its own brackets), or len(tokens) if none
+        self.region_end = array('i', [len(keys)]) * len(keys)
+        if self.balanced:
+            ends = [len(keys)]
+            for index, key in enumerate(keys):
+                if key in opening_of:
+                    ends.pop()
+                self.region_end[index] = ends[-1]
+                if key in closing_of:
+                    ends.append(self.match[index])
+
+    def possible(self, start, required):
+        """ Can a parse from index start contain all of required brackets (keys)?"""
+        end = self.region_end[start]
+        for key in required:
+            positions = self.positions[key]
+            index = bisect.bisect_left(positions, start)
+            if index == len(positions) or positions[index] >= end:
+                return False
+        return True
+
+
+class Pins:
+    """ Token indices pinned by the parser: it pins the index of each point
+            it may backtrack to, and unpins it when it no longer may.
+    """
+    def __init__(self):
+        self.pins = {}              # pins[index] is number of pins at index
+
+    def pin(self, index):
+        """ Keep tokens from index on, until unpinned."""
+        self.pins[index] = self.pins.get(index, 0) + 1
+
+    def unpin(self, index):
+        """ Remove a pin from index."""
+        count = self.pins[index] - 1
+        if count:
+            self.pins[index] = count
+        else:
+            del self.pins[index]
+
+
+class TokenBuffer(Pins):
+    """ Sequence of tokens read as needed from an iterator, for a streaming parse.
+        Tokens are dropped once the parser can no longer return to them:
+            tokens before the lowest pin (or before the token being read) are dropped.
+        If keep, every token read is also kept in self.kept (to build the parse tree
+            of the whole source), and tokens dropped can still be indexed.
+    """
+    trim_interval = 256         # number of tokens read between trims of buffer
+
+    def __init__(self, iterator, keep=False):
+        Pins.__init__(self)
+        self.iterator = iter(iterator)
+        self.tokens = []            # buffered tokens
+        self.kept = [] if keep else None    # all tokens read, if keep
+        self.offset = 0             # index of first buffered token
+        self.last = None            # last token read
+        self.numread = 0            # number of tokens read from iterator
+        self.exhausted = False      # True when iterator has no more tokens
+        self.maxsize = 0            # greatest number of tokens buffered
+
+    def __getitem__(self, index):
+        """ Return token at index, reading tokens as needed;
+            raise IndexError if past end of tokens, or token was dropped."""
+        position = index - self.offset
+        if 0 <= position < len(self.tokens):
+            return self.tokens[position]
+        if position < 0:
+            if self.kept is not None:
+                return self.kept[index]
+            raise IndexError('Token %d is no longer buffered' % index)
+        while position >= len(self.tokens):
+            if self.exhausted:
+                raise IndexError('Token %d is past end of tokens' % index)
+            self.read(index)
+            position = index - self.offset
+        return self.tokens[position]
+
+    def read(self, index):
+        """ Read next token from iterator; index is position being sought."""
+        try:
+            token = next(self.iterator)
+        except StopIteration:
+            self.exhausted = True
+            return
+        self.tokens.append(token)
+        if self.kept is not None:
+            self.kept.append(token)
+        self.last = token
+        self.numread += 1
+        self.maxsize = max(self.maxsize, len(self.tokens))
+        if self.numread % self.trim_interval == 0:
+            floor = min(self.pins) if self.pins else index
+            self.trim(min(floor, index))
+
+    def trim(self, floor):
+        """ Drop buffered tokens before index floor."""
+        if floor > self.offset:
+            del self.tokens[:floor - self.offset]
+            self.offset = floor
+
+    def at_end(self, index):
+        """ Return True if there is no token at index."""
+        if index - self.offset < len(self.tokens):
+            return False
+        try:
+            self[index]
+        except IndexError:
+            return index >= self.offset
+        return False
+
+    def window(self, start, end):
+        """ Return list of tokens from index start to end that are still buffered."""
+        start = max(start - self.offset, 0)
+        return self.tokens[start:max(end - self.offset, 0)]
+
+
+class ParseMemo(Pins):
+    """ Results of parsing nonterms at token indices, reused when the parser
+            tries the same nonterm at the same index again (packrat parsing).
+        An entry is (failure, number of tokens parsed);
+            successful parses of no tokens are not kept.
+        When there are more than max_entries, entries before the lowest pin
+            (which the parser will not need again) are dropped,
+            then those with the lowest indices, down to half of max_entries.
+    """
+    max_entries = 65536
+
+    def __init__(self):
+        Pins.__init__(self)
+        self.entries = {}           # entries[(start, nonterm name)] is entry
+        self.hits = 0               # number of parses reused
+        self.misses = 0             # number of parses stored
+
+    def get(self, start, nonterm):
+        """ Return entry for nonterm parsed at index start, or None."""
+        entry = self.entries.get((start, nonterm.name))
+        if entry:
+            self.hits += 1
+        return entry
+
+    def store(self, start, nonterm, failure, numtokens):
+        """ Store entry for nonterm parsed at index start."""
+        if numtokens or failure:
+            self.misses += 1
+            self.entries[(start, nonterm.name)] = (failure, numtokens)
+            if len(self.entries) > self.max_entries:
+                self.evict(min(self.pins) if self.pins else start)
+
+    def evict(self, floor):
+        """ Drop entries before index floor, and more if needed to halve entries."""
+        keys = [key for key in self.entries if key[0] < floor]
+        excess = len(self.entries) - self.max_entries // 2
+        if len(keys) < excess:
+            keys = sorted(self.entries)[:excess]
+        for key in keys:
+            del self.entries[key]
+
+
+class Frame:
+    """ Parse of a nonterm from a token index (see SyntaxParser.open_frame):
+            alternates to parse, and best parse of those parsed so far;
+            for SyntaxParser.parse_stack, also progress in alternate being parsed.
+    """
+    def __init__(self, start, nonterm, level, alts):
+        self.start = start
+        self.nonterm = nonterm
+        self.level = level          # level in parse tree
+        self.alts = alts            # alternates possible at start
+        self.choice = None          # alternate of longest successful parse
+        self.failure = 'not set'    # replace with failed item, or None
+        self.maxtokens = 0          # max number of tokens parsed among alternates
+        self.ordered = False        # True to keep first successful parse
+        self.backtrack = False      # True if start is pinned to parse next alternate
+        self.done = False           # True if no more alternates to parse
+        self.altindex = 0           # index in alts of alternate being parsed
+        self.alt = None             # alternate being parsed (saved by parse_stack)
+        self.itemindex = 0          # index of item being parsed
+        self.numtokens = 0          # number of tokens parsed by alternate so far
+        self.repeat = False         # True if parsing a repetition of item
+
+
+class TreeBuilder:
+    """ Builds parse tree of a successful parse, from the alternate parsed for each nonterm
+            and its number of tokens (SyntaxParser.derivation): the alternates are
+            matched again, but no nodes are made for alternates discarded by the parse.
+        Tokens are a sequence, or a TokenBuffer (indexed only where parsed), with
+            at_end(index) True if there is no token at index (see SyntaxParser.at_end).
+        Items are matched as by SyntaxParser.parse_alt and parse_item;
+            a nonterm fails where no alternate was recorded for it.
+        Nonterms are built from a list of those pending (not by recursion),
+            so depth of tree is not limited.
+    """
+    def __init__(self, syntax, tokens, derivation, at_end=None):
+        self.nonterms = syntax.nonterms
+        self.tokens = tokens            # tokens parsed
+        self.at_end = at_end or self.past_end
+        self.derivation = derivation
+
+    def past_end(self, index):
+        """ Return True if index is past the last of a sequence of tokens."""
+        return index >= len(self.tokens)
+
+    def build(self, start, nonterm, node):
+        """ Build parse tree of nonterm parsed from token index start in node;
+            return number of tokens parsed."""
+        count = self.derivation[(start, nonterm.name)][1]
+        pending = [(start, nonterm, node)]
+        while pending:
+            start, nonterm, node = pending.pop()
+            node.set_location(self.tokens[start])
+            alternate = self.derivation[(start, nonterm.name)][0]
+            numtokens = 0
+            for item in alternate.items:
+                if item.quantifier == '1':      # no quantifier
+                    numtokens += self.build_item(start + numtokens, item, node, pending)
+                    continue
+                qnode = node.add_child(item.strq())     # cover node, named item with quantifier
+                nt = self.build_item(start + numtokens, item, qnode, pending)
+                while nt is not None:
+                    numtokens += nt
+                    if item.quantifier == '?' or self.at_end(start + numtokens):
+                        break
+                    if item.separator:
+                        if self.tokens[start + numtokens].text != item.separator:
+                            break
+                        numtokens += 1
+                    nt = self.build_item(start + numtokens, item, qnode, pending)
+        return count
+
+    def build_item(self, start, item, node, pending):
+        """ Build parse tree of item parsed from token index start in node
+                (a nonterm child is added to list pending, to be built);
+            return number of tokens parsed, or None if item fails there."""
+        if self.at_end(start):
+            return None
+        token = self.tokens[start]
+        node.set_location(token)
+        if item.isterminal():
+            match_text = token.text if item.isliteral() else token.name
+            if match_text != item.text():
+                return None
+            if token.text and not item.isliteral():
+                # don't output NEWLINE, INDENT, DEDENT, or literals
+                node.add_child(token)   # terminal node
+            if token.trailing:
+                node.add_comments(token.trailing)
+            return 1
+        nonterm = self.nonterms[item.text()]
+        entry = self.derivation.get((start, nonterm.name))
+        if entry is None:
+            return None
+        pending.append((start, nonterm, node.add_child(nonterm.name)))
+        return entry[1]
+
+
 class SyntaxParser:
     """ Parse source code into syntax tree.
         Loads token and syntax grammars on initialization, to direct parsing.
     """
+    chunk_size = 2048           # least number of tokens of a chunk (see parse_parallel)
+
     def __init__(self, langpath, debug=''):
         """ Create parser by loading syntax grammar (langpath.syntax) and 
             token grammar (langpath.tokens).
@@ -57,6 +605,27 @@ class SyntaxParser:
         if '2' in self.debug:
             print 'Syntax spec loaded from ' + self.syntax.filepath
             
+        # bracket pairs for BracketIndex: closing brackets must be punctuation tokens
+        pairs = [pair for pair in bracket_pairs[:-1]
+                    if all(self.tokenizer.lex_line(bracket, 1)[0][0][0] == '' 
+                            for bracket in pair)]
+        if 'indent' in self.tokenizer.tokendef.options:
+            pairs.append(bracket_pairs[-1])
+        self.syntax.find_brackets(pairs)
+        
+        # lookahead tries, to choose alternates by the next tokens
+        kinds = {}
+        def kind_of(text):
+            """ Return name of token kind of text (first token, if more than one)."""
+            if text not in kinds:
+                tokens = self.tokenizer.lex_line(text, 1)[0]
+                kinds[text] = tokens[0][0] if tokens else ''
+            return kinds[text]
+        self.syntax.find_lookahead(lookahead_depth, kind_of)
+        if '2' in self.debug and self.syntax.conflicts:
+            print 'Nonterms not LL(%d), alternates tried in turn:' % lookahead_depth,
+            print ' '.join(self.syntax.conflicts)
+        
         if 's' in self.debug:
             self.syntax.show()
         if 'p' in self.debug:
@@ -65,42 +634,111 @@ class SyntaxParser:
         self.source_path = ''       # last source file parsed
         self.maxtokens = 0          # greatest number of tokens parsed before a parse failure
         self.expected = None        # grammar item expected at furthest failure
-        self.tokens = None          # list of tokens in source file
+        self.tokens = None          # list of tokens in source file (or TokenBuffer)
+        self.buffer = None          # TokenBuffer if streaming tokens, else None
+        self.brackets = None        # BracketIndex of tokens, if usable
+        self.dispatch = False       # True to choose alternates by lookahead (not streaming)
+        self.memo = None            # ParseMemo, if memoizing parses
+        self.derivation = {}        # derivation[(start, nonterm name)] is
+                                    #   (alternate parsed, number of tokens)
+        self.pinned = []            # TokenBuffer and ParseMemo (if used), to pin indices
+        self.tree = None            # parse tree of last source parsed (not streamed)
+        self.items = None           # token indices where occurrences of syntax.repeated
+                                    #   begin in self.tree (None if not known)
+        self.chunks = 0             # number of chunks of last source parsed in parallel
+                                    #   (0 if parsed sequentially)
         self.newtoken = False       # True when new token will be parsed (for trace display)
+        self.tracer = tracing.Tracer()      # trace of parse, off unless a sink is added
+        if any(verbosity in self.debug for verbosity in '345'):
+            self.tracer.add(tracing.PrintSink(self.debug))
+        self.profile = None         # ParseProfile (a tracing sink), if profiling parses
+        if 'h' in self.debug or 'j' in self.debug:
+            self.profile = self.tracer.add(profiler.ParseProfile())
 
         
-    def parse(self, filepath, enable_imports=False):
+    def parse(self, filepath, enable_imports=False, stream=False, processes=1):
         """ Parse given source file, return root node of parse tree.
             Syntax error will raise Error exception.
             If imports enabled, source may import other source files.
+            If stream, tokens are read as needed by the parser, and dropped when
+                no longer needed, instead of tokenizing the whole file first.
+            If processes > 1 (and not stream), occurrences of the repeated item of
+                the root are parsed in parallel by that many processes (see parse_parallel).
+        """
+        if stream:
+            tokens = self.tokenizer.generate_tokens(filepath, enable_imports=enable_imports)
+        else:
+            tokens = self.tokenizer.get_tokens(filepath, enable_imports=enable_imports)
+        return self.parse_source(filepath, tokens, stream, processes)
+
+
+    def parse_from(self, source, name='<string>', stream=False, processes=1):
+        """ Parse source: a string, or an iterable of lines (such as a file object);
+                name is used as filepath of locations (e.g. in error messages).
+            Return root node of parse tree, as for parse().
+        """
+        if stream:
+            tokens = self.tokenizer.generate_tokens_from(source, name)
+        else:
+            tokens = self.tokenizer.get_tokens_from(source, name)
+        return self.parse_source(name, tokens, stream, processes)
+
+
+    def parse_source(self, filepath, tokens, stream, processes=1):
+        """ Parse tokens of source at filepath: a TokenStream,
+                or if stream, a generator of tokens; return root node of parse tree.
+            If processes > 1, parse in parallel if possible (see parse_parallel).
         """
         self.source_path = filepath
-        self.tokens = self.tokenizer.get_tokens(filepath, enable_imports=enable_imports)
+        self.maxtokens = 0
+        self.expected = None
+        self.brackets = None
+        self.dispatch = False
+        if stream:
+            # occurrences of syntax.repeated are built as parsed, unless traced (see
+            #   parse_stream); else all tokens are kept, to build tree of whole source
+            keep = not self.syntax.repeated or bool(self.tracer.sinks)
+            self.buffer = self.tokens = TokenBuffer(tokens, keep)
+            self.buffer.pin(self.maxtokens)
+        else:
+            self.buffer = None
+            self.tokens = tokens
+            if self.syntax.bracket_pairs and 'k' not in self.debug:
+                brackets = BracketIndex(self.tokens, self.syntax.bracket_pairs)
+                if brackets.balanced:
+                    self.brackets = brackets
+            self.dispatch = 'q' not in self.debug
         
-        if 'o' in self.debug:
-            print '\nTokens from ' + filepath + ':\n'
-            for tkn in self.tokens:
-                print tkn
-            print
-        if 'r' in self.debug:
-            print '\nReassembled source from tokens:'
-            print tokenize.reassemble(self.tokens)
+            if 'o' in self.debug:
+                print '\nTokens from ' + filepath + ':\n'
+                for tkn in tokenize.with_trivia(self.tokens):
+                    print tkn
+                print
+            if 'r' in self.debug:
+                print '\nReassembled source from tokens:'
+                print tokenize.reassemble(self.tokens)
             
-        # Start at syntax root, find terminals matching tokens of source file.
-        # Build parse tree depth-first, climbing syntax to classify nodes.
-        nonterm = self.syntax.root
-        parse_tree = parsetree.new(nonterm.name, self.debug)    # root of parse tree
-        self.log(3, '\n\nParse trace:\n')
-        if self.tokens:
-            numtokens = self.parse_comments(0, parse_tree)
-            self.newtoken = True
-            failure, nt = self.parse_nonterm(numtokens, nonterm, parse_tree)
-            numtokens += nt
-            
-            if failure or numtokens < len(self.tokens):     # end not reached
-                self.syntax_error(numtokens)
-            elif '1' in self.debug:
-                print '\n%s parsed successfully (%d tokens)' % (filepath, numtokens)
+        self.chunks = 0
+        if processes > 1 and not stream:
+            parse_tree, success, numtokens = self.parse_parallel(processes)
+        else:
+            parse_tree, success, numtokens = self.parse_tokens()
+        if not success and (self.brackets or self.dispatch):
+            # Alternates rejected using bracket index or lookahead might have parsed
+            #   further: parse again without them, to report the furthest failure.
+            self.brackets = None
+            self.dispatch = False
+            self.maxtokens = 0
+            self.expected = None
+            parse_tree, success, numtokens = self.parse_tokens()
+        if 'h' in self.debug:
+            print self.profile.table()
+        if 'j' in self.debug:
+            print self.profile.json()
+        if not success:
+            self.syntax_error(numtokens)
+        elif numtokens and '1' in self.debug:
+            print '\n%s parsed successfully (%d tokens)' % (filepath, numtokens)
                 
         if 't' in self.debug:
             print '\nTree:\n'
@@ -108,101 +746,460 @@ class SyntaxParser:
         return parse_tree
 
 
+    def parse_tokens(self):
+        """ Parse self.tokens using syntax root.
+            Return (parse tree, success, number of tokens parsed).
+        """
+        # Start at syntax root, find terminals matching tokens of source file,
+        #   climbing syntax to classify them; record alternate chosen for each nonterm.
+        # If successful, build parse tree of the chosen alternates only.
+        nonterm = self.syntax.root
+        parse_tree = parsetree.new(nonterm.name, self.debug)    # root of parse tree
+        self.memo = ParseMemo() if 'c' in self.debug else None
+        self.pinned = [pins for pins in (self.buffer, self.memo) if pins]
+        self.derivation = {}
+        self.tree = self.items = None
+        if self.tracer.sinks:
+            self.trace('begin', ('Parse',))
+        if self.at_end(0):
+            return parse_tree, True, 0
+        self.parse_comments(self.tokens[0].leading, parse_tree)
+        self.newtoken = True
+        if self.buffer and self.buffer.kept is None:
+            failure, numtokens = self.parse_stream(parse_tree)
+            return parse_tree, not failure and self.at_end(numtokens), numtokens
+        if 'u' in self.debug:
+            failure, numtokens = self.parse_stack(0, nonterm, 0)
+        else:
+            failure, numtokens = self.parse_nonterm(0, nonterm, 0)
+        success = not failure and self.at_end(numtokens)
+        if success:
+            builder = TreeBuilder(self.syntax, self.tokens, self.derivation, self.at_end)
+            builder.build(0, nonterm, parse_tree)
+            if not self.buffer:
+                self.tree = parse_tree
+                self.items = self.item_starts(numtokens)
+        return parse_tree, success, numtokens
+
+
+    def parse_stream(self, parse_tree):
+        """ Parse occurrences of syntax.repeated (the only item of the root) in turn
+                from self.buffer, as parse_tokens parses the root, adding the tree of
+                each to parse_tree as soon as it is parsed. The parser will not return
+                to its tokens, so they are dropped from the buffer, with its entries in
+                self.derivation: memory is bounded by the longest occurrence.
+            (The root is not traced, so this is not used when the parse is traced.)
+            Return parse item that failed (or None), number of tokens parsed.
+        """
+        item = self.syntax.repeated
+        cover = parse_tree.add_child(item.strq())
+        parse_tree.set_location(self.tokens[0])
+        cover.set_location(self.tokens[0])
+        start = 0
+        while not self.at_end(start):
+            self.buffer.pin(start)          # keep tokens of occurrence, to build its tree
+            failure, numtokens, node = self.parse_occurrence(start)
+            self.buffer.unpin(start)
+            if failure or not numtokens:
+                if failure and not start and item.quantifier == '+':
+                    return failure, numtokens       # root fails
+                break                       # root parsed start tokens
+            cover.children.append(node)
+            start += numtokens
+            self.derivation = dict((key, entry) for key, entry in self.derivation.items()
+                                    if key[0] >= start)
+        return None, start
+
+
+    def item_starts(self, numtokens):
+        """ Return list of token indices where occurrences of syntax.repeated begin,
+            in root parsed (numtokens), from self.derivation; None if no such item."""
+        item = self.syntax.repeated
+        if not item:
+            return None
+        starts = []
+        start = 0
+        while start < numtokens:
+            starts.append(start)
+            start += self.derivation[(start, item.text())][1]
+        return starts
+
+
+    def parse_parallel(self, processes):
+        """ Parse self.tokens as for parse_tokens, but with occurrences of the repeated
+                item of the root (syntax.repeated, e.g. extdeclaration+) parsed in
+                chunks of tokens by a pool of processes; their trees are merged.
+            Tokens are split where an occurrence is likely to begin (see chunk_starts);
+                in each chunk, occurrences are parsed from its first token until one
+                ends at or after the end of the chunk.
+            If a split was not between occurrences (an occurrence parsed in the chunk
+                before it does not end where one in the chunk begins), or a chunk fails,
+                or occurrences merged do not end at the last token, tokens are parsed
+                again sequentially, by parse_tokens.
+            Parsing is sequential also if no chunks can be made (e.g. the brackets
+                of tokens are not balanced), or if the parse is traced.
+        """
+        item = self.syntax.repeated
+        starts = []
+        if item and self.brackets and not self.tracer.sinks:
+            numchunks = min(processes * 4, len(self.tokens) // self.chunk_size)
+            starts = self.chunk_starts(numchunks)
+        if len(starts) < 2:
+            return self.parse_tokens()
+        chunks = zip(starts, starts[1:] + [len(self.tokens)])
+        pool = multiprocessing.Pool(processes, init_worker, (self,))
+        try:
+            # chunks parsed are merged while the rest are parsed
+            merged = merge_occurrences(pool.imap(parse_chunk, chunks))
+        finally:
+            pool.close()    # (terminate may deadlock while a worker sends a result)
+            pool.join()
+        if not merged or merged[2] != len(self.tokens):
+            return self.parse_tokens()
+        nodes, items, numtokens = merged
+        
+        root = self.syntax.root
+        parse_tree = parsetree.new(root.name, self.debug)
+        self.parse_comments(self.tokens[0].leading, parse_tree)
+        cover = parse_tree.add_child(item.strq())
+        parse_tree.set_location(self.tokens[0])
+        cover.set_location(self.tokens[0])
+        cover.children = nodes
+        self.memo = None
+        self.derivation = {}
+        self.tree = parse_tree
+        self.items = items
+        self.chunks = len(chunks)
+        return parse_tree, True, numtokens
+
+
+    def chunk_starts(self, numchunks):
+        """ Return token indices where self.tokens may be split into up to numchunks
+                chunks of about equal size: 0, then for each other chunk, the first
+                index from its share of tokens at which an occurrence of syntax.repeated
+                is likely to begin, where a token that may begin one follows a token
+                that may end one, both outside all bracket regions."""
+        nonterm = self.syntax.nonterms[self.syntax.repeated.text()]
+        first = nonterm.prefix_mask & ~1        # (bit 1 is an empty parse)
+        last = self.syntax.suffix_masks[nonterm.name] & ~1
+        token_mask = self.syntax.token_mask
+        numtokens = len(self.tokens)
+        region_end = self.brackets.region_end
+        starts = [0]
+        for chunk in range(1, numchunks):
+            index = max(chunk * numtokens // numchunks, starts[-1] + 1)
+            while index < numtokens:
+                if (region_end[index] == numtokens == region_end[index - 1] and
+                        token_mask(self.tokens[index]) & first and
+                        token_mask(self.tokens[index - 1]) & last):
+                    starts.append(index)
+                    break
+                index += 1
+        return starts
+
+
+    def parse_occurrences(self, start, end):
+        """ Parse occurrences of syntax.repeated from token index start, until one ends
+                at or after index end (for a chunk of parse_parallel).
+            Return list of (start, number of tokens, node) of occurrences, or None
+                if one fails, or parses no tokens.
+        """
+        self.memo = ParseMemo() if 'c' in self.debug else None
+        self.pinned = [self.memo] if self.memo else []
+        self.derivation = {}
+        occurrences = []
+        try:
+            while start < end:
+                failure, numtokens, node = self.parse_occurrence(start)
+                if failure or not numtokens:
+                    return None
+                occurrences.append((start, numtokens, node))
+                start += numtokens
+        except Error:           # e.g. ambiguous parse
+            return None
+        return occurrences
+
+
+    def parse_occurrence(self, start):
+        """ Parse occurrence of syntax.repeated from token index start.
+            Return parse item that failed (or None), number of tokens parsed,
+                and parse tree of occurrence (None if failure).
+        """
+        item = self.syntax.repeated
+        nonterm = self.syntax.nonterms[item.text()]
+        self.newtoken = True
+        if 'u' in self.debug:
+            failure, numtokens = self.parse_stack(start, nonterm, 2)
+        else:
+            failure, numtokens = self.parse_item(start, item, 1)
+        if failure:
+            return failure, numtokens, None
+        node = parsetree.new(nonterm.name, self.debug)
+        node.level = 2          # below root and cover node of occurrences
+        builder = TreeBuilder(self.syntax, self.tokens, self.derivation, self.at_end)
+        builder.build(start, nonterm, node)
+        return None, numtokens, node
+
+
+    def reparse(self, tree, tokens, lines, changes):
+        """ Update parse tree and TokenStream tokens of last source parsed, after source
+                is edited: lines is list of lines of edited source, changes is list of
+                (linenum, removed, added), as for Tokenizer.retokenize.
+            Only occurrences of the repeated item of the root (syntax.repeated,
+                e.g. extdeclaration+) that contain changed tokens are parsed again,
+                with the occurrence before them (whose parse may have looked ahead
+                into them), and those after them until an occurrence begins at an
+                unchanged token; other nodes are kept, with locations updated.
+            Return parse tree (tree updated in place, or a new tree if the whole
+                source had to be parsed again). Syntax error will raise Error exception.
+        """
+        incremental = (tree is self.tree and tokens is self.tokens and self.items
+                        and tree.children)
+        self.tokenizer.retokenize(tokens, lines, changes)
+        if not incremental or not len(tokens):
+            return self.parse_source(self.source_path, tokens, False)
+        
+        # Tokens replaced: old[first:end] became new[first:end + offset]
+        first = end = len(tokens)
+        offset = 0
+        for start, stop, numtokens in tokens.spliced:
+            first = min(first, start)
+            end = stop - offset
+            offset += numtokens - (stop - start)
+        end = max(end, first)
+        
+        items = self.items
+        cover = tree.children[0]        # cover node of occurrences of repeated item
+        first_item = max(bisect.bisect_right(items, first) - 2, 0)
+        start = items[first_item]
+        self.maxtokens = 0
+        self.expected = None
+        self.brackets = None
+        self.dispatch = 'q' not in self.debug
+        self.memo = ParseMemo() if 'c' in self.debug else None
+        self.pinned = [self.memo] if self.memo else []
+        self.derivation = {}
+        if self.tracer.sinks:
+            self.trace('begin', ('Reparse',))
+        
+        begin = start
+        nodes = []              # nodes of occurrences parsed
+        starts = []             # and their token indices
+        last_item = len(items)  # first occurrence kept after those parsed
+        while not self.at_end(start):
+            if start >= end + offset:
+                index = bisect.bisect_left(items, start - offset)
+                if index < len(items) and items[index] == start - offset:
+                    last_item = index       # rest of parse is unchanged
+                    break
+            failure, numtokens, node = self.parse_occurrence(start)
+            if failure:
+                # parse whole source, to report the furthest failure
+                return self.parse_source(self.source_path, tokens, False)
+            nodes.append(node)
+            starts.append(start)
+            start += numtokens
+        
+        # Update line numbers of nodes kept after those parsed
+        if last_item < len(items):
+            linenum = locations.unpack(cover.children[last_item].position)[1]
+            parsetree.relocate(cover.children[last_item:],
+                                locations.unpack(tokens[start].position)[1] - linenum)
+        cover.children[first_item:last_item] = nodes
+        items[first_item:] = starts + [index + offset for index in items[last_item:]]
+        tree.position = cover.position = tokens[0].position
+        tree.comments = ()
+        self.parse_comments(tokens[0].leading, tree)
+        if '1' in self.debug:
+            print '\n%s reparsed %d of %d tokens' % (self.source_path,
+                                                        start - begin, len(tokens))
+        return tree
+
+
     def syntax_error(self, numtokens):
         """ Raise Error with appropriate message for furthest token reached. """
-        message = '\nParsed %d tokens of %d total for %s'
-        print message % (numtokens, len(self.tokens), self.source_path)
-        if self.maxtokens < len(self.tokens):
+        if self.buffer:
+            message = '\nParsed %d tokens of %d read for %s'
+            print message % (numtokens, self.buffer.numread, self.source_path)
+        else:
+            message = '\nParsed %d tokens of %d total for %s'
+            print message % (numtokens, len(self.tokens), self.source_path)
+        if not self.at_end(self.maxtokens):
            token = self.tokens[self.maxtokens]
            message = 'Syntax error at %s token "%s"' % (token.name, token.text)
         else:
-           token = self.tokens[-1]
+           token = self.buffer.last if self.buffer else self.tokens[-1]
            message = 'Syntax error at end of file'
         message += ': expecting %s' % self.expected
         raise token.location.error(message)
     
 
-    def parse_comments(self, start, node):
-        """ Parse comments from self.tokens beginning at index start, add them to node;
-            return number of comment tokens."""
-        numtokens = 0
-        for token in self.tokens[start:]:
-            if token.name == 'COMMENT':
-                node.add_child(token)
-                self.log(5, 'COMMENT from line %d: %s' % (token.location.linenum, token.text))
-                numtokens += 1
-            else:
-                break
-        return numtokens
+    def at_end(self, index):
+        """ Return True if there is no token at index (end of tokens reached)."""
+        if self.buffer:
+            return self.buffer.at_end(index)
+        return index >= len(self.tokens)
+
+
+    def token_list(self, start, end):
+        """ Return list of tokens from index start to end (those still buffered)."""
+        if self.buffer:
+            return self.buffer.window(start, end)
+        return self.tokens[start:end]
+
+
+    def pin(self, index):
+        """ Pin index the parser may backtrack to (see Pins)."""
+        for pins in self.pinned:
+            pins.pin(index)
+
+
+    def unpin(self, index):
+        for pins in self.pinned:
+            pins.unpin(index)
+
+
+    def parse_comments(self, comments, node=None):
+        """ Trace comments (trivia of a token parsed); add them to comments of node, if any.
+            (Comments of tokens after the first are added by TreeBuilder.)"""
+        if comments:
+            if node:
+                node.add_comments(comments)
+            if self.tracer.sinks:
+                for token in comments:
+                    self.trace('comment', (token.location.linenum, token.text))
         
 
-    def parse_nonterm(self, start, nonterm, node):
-        """ Parse tokens from index start using syntax of nonterm;
-                if successful, store parse tree in node. 
+    def parse_nonterm(self, start, nonterm, level):
+        """ Parse tokens from index start using syntax of nonterm, at level of tree;
+                if successful, record alternate parsed in self.derivation.
             Return parse item that failed (or None), number of tokens parsed.
             If success, keep parse that parses the most tokens (first if tied);
                 if failure, return failure that parses the most tokens (first if tied).
+            With ordered choice (debug 'f'), keep parse of first successful alternate,
+                without trying the rest, unless nonterm has flag .longest.
         """
-        maxtokens = 0           # max number of tokens parsed among alternates
+        frame = self.open_frame(start, nonterm, level)
+        for alt in frame.alts:
+            if self.tracer.sinks:
+                self.trace('alternate', (nonterm, alt), level, start)
+            fail, numtokens = self.parse_alt(start, alt, level)
+            if self.end_alt(frame, alt, fail, numtokens):
+                break                           # first success wins
+        return self.close_frame(frame)
+
+
+    def open_frame(self, start, nonterm, level):
+        """ Return Frame to parse nonterm from index start, with alternates possible there."""
         token = self.tokens[start]
-        node.set_location(token)
-        if self.newtoken:
-            self.log(3, token)      # display new token once
+        if self.newtoken and self.tracer.sinks:
+            self.trace('token', (token,))       # display new token once
             self.newtoken = False
         
-        if self.inprefixes(token, nonterm.prefixes):
+        alts = []
+        grammar, bits = token.prefix_mask       # (Tokens may be parsed by other grammars)
+        if grammar is not self.syntax:
+            bits = self.syntax.token_mask(token)
+            token.prefix_mask = (self.syntax, bits)
+        if bits & nonterm.prefix_mask:
             # token must be in prefixes of some alternate
-            numchildren = 0     # number of children parsed from longest successful alternate
-            failure = 'not set'     # replace with failed item, or None
-            
-            # Parse all alternates, retain longest (successful, if any) parse
-            for alt in nonterm.alternates:
-                if self.inprefixes(token, alt.prefixes):    # this alternate may match
-                    self.log(3, '%s => %s' % (nonterm, alt), node)
-                    fail, numtokens = self.parse_alt(start, alt, node)
-                    if not fail:
-                        tokens = self.tokens[start:][:numtokens]
-                        self.log(4, '%s: %s' % (nonterm, listtokens(tokens)), node)
-                        if numtokens == maxtokens and not failure and 'a' not in self.debug:
-                            # a second alternate matches the same tokens
-                            raise tokens[-1].location.error('Ambiguous parse of %s' % nonterm)
-                        
-                    if failure or not fail:     # status same or better than previous best
-                        first_alt = (failure == 'not set')          # first alternate
-                        first_success = failure and not fail
-                        if numtokens > maxtokens or first_success or first_alt:
-                            maxtokens = numtokens
-                            failure = fail              # save result
-                            if not fail:                # remove previous alt's parse
-                                node.remove_children(numchildren)
-                                numchildren = node.numchildren()
-                    
-                    if node.numchildren() > numchildren:    # if this parse was not best,
-                        node.keep_children(numchildren)     #   discard it and keep previous
+            alts = [alt for alt in nonterm.alternates if bits & alt.prefix_mask]
+            if self.dispatch and len(alts) > 1:
+                # alternate must match the next tokens (see SyntaxGrammar.find_lookahead)
+                mask = self.lookahead(start, nonterm.dispatch)
+                alts = [alt for alt in alts if alt.mask & mask]
+            if self.brackets:
+                # alternate's required brackets must be in region containing token
+                possible = self.brackets.possible
+                alts = [alt for alt in alts if not alt.required or possible(start, alt.required)]
         
-        else:   # fail, nonterm not possible with this token
-            failure = nonterm
+        frame = Frame(start, nonterm, level, alts)
+        if self.tracer.sinks:
+            self.trace('open', (nonterm,), level, start)
+        if alts:
+            frame.ordered = 'f' in self.debug and not nonterm.longest
+            frame.backtrack = self.pinned and len(alts) > 1
+            if frame.backtrack:
+                self.pin(start)             # keep tokens to parse next alternate
+        else:   # fail, nonterm not possible with this token (or in its region)
+            frame.failure = nonterm
+        return frame
+
+
+    def end_alt(self, frame, alt, fail, numtokens):
+        """ Keep parse of alternate alt in frame if longest so far (successful, if any).
+            Return True if no more alternates are to be parsed (ordered choice)."""
+        if self.tracer.sinks:
+            self.trace('end', (frame.nonterm, alt, fail, numtokens), frame.level, frame.start)
+        if not fail:
+            if self.tracer.sinks:
+                tokens = self.token_list(frame.start, frame.start + numtokens)
+                self.trace('parsed', (frame.nonterm, tokens), frame.level, frame.start)
+            if numtokens == frame.maxtokens and not frame.failure and 'a' not in self.debug:
+                # a second alternate matches the same tokens
+                token = self.token_list(frame.start, frame.start + numtokens)[-1]
+                raise token.location.error('Ambiguous parse of %s' % frame.nonterm)
+            
+        if frame.failure or not fail:       # status same or better than previous best
+            first_alt = (frame.failure == 'not set')        # first alternate
+            first_success = frame.failure and not fail
+            if numtokens > frame.maxtokens or first_success or first_alt:
+                frame.maxtokens = numtokens
+                frame.failure = fail            # save result
+                if not fail:
+                    frame.choice = alt
+        return frame.ordered and not frame.failure
+
+
+    def close_frame(self, frame):
+        """ Record result of parse of frame (see parse_nonterm), and return it."""
+        start, nonterm, level = frame.start, frame.nonterm, frame.level
+        failure, maxtokens = frame.failure, frame.maxtokens
+        if frame.backtrack:
+            self.unpin(start)
+        if self.tracer.sinks:
+            self.trace('close', (nonterm, frame.choice, failure, maxtokens), level, start)
         
-        if failure:
+        if not failure:
+            self.derivation[(start, nonterm.name)] = (frame.choice, maxtokens)
+        else:
             if start + maxtokens > self.maxtokens:
+                if self.buffer:                         # keep token for error message
+                    self.buffer.unpin(self.maxtokens)
+                    self.buffer.pin(start + maxtokens)
                 self.maxtokens = start + maxtokens      # record furthest failure
                 self.expected = failure
-            if isinstance(failure, grammar.Nonterminal):
-                self.log(4, '%s failed: expected one of ' % nonterm, node)
-                self.log(4, '    %s' % list(failure.prefixes), node)
-            else:
-                self.log(4, '%s failed: expected %s' % (nonterm, failure), node)
+            if self.tracer.sinks:
+                if isinstance(failure, grammar.Nonterminal):
+                    self.trace('unexpected', (nonterm, list(failure.prefixes)), level, start)
+                else:
+                    self.trace('failed', (nonterm, failure), level, start)
         return failure, maxtokens
 
 
-    @staticmethod
-    def inprefixes(token, prefixes):
-        """ Return true if token matches any of prefixes."""
-        return token.text in prefixes or token.name in prefixes
-        
-    
-    def parse_alt(self, start, alternate, node):
-        """ Parse tokens from index start using syntax of alternate; store parse tree in node. 
+    def lookahead(self, start, trie):
+        """ Return mask of alternates in lookahead trie that may match tokens from
+            index start: each token matches a terminal by its text or its kind."""
+        mask = trie[0]
+        nodes = [trie]
+        index = start
+        while nodes and index < start + lookahead_depth and not self.at_end(index):
+            token = self.tokens[index]
+            matched = []
+            for node in nodes:
+                children = node[1]
+                for terminal in (token.text, token.name):
+                    child = children.get(terminal)
+                    if child:
+                        mask |= child[0]
+                        matched.append(child)
+            nodes = matched
+            index += 1
+        return mask
+
+
+    def parse_alt(self, start, alternate, level):
+        """ Parse tokens from index start using syntax of alternate, at level of tree.
             Return parse item that failed (or None), number of tokens parsed.
             (Quantifiers handled here.)
         """
@@ -211,12 +1208,16 @@ class SyntaxParser:
         for item in alternate.items:
             
             if item.quantifier == '1':      # no quantifier
-                failure, nt = self.parse_item(start + numtokens, item, node)
+                failure, nt = self.parse_item(start + numtokens, item, level)
                 numtokens += nt
             
-            else:       # quantified item: make cover node, occurrences are children of it
-                qnode = node.add_child(item.strq())     # name is item followed by quantifier
-                failure, nt = self.parse_item(start + numtokens, item, qnode)
+            else:       # quantified item: occurrences are a level below, in cover node
+                optional = self.pinned and item.quantifier in '?*'
+                if optional:                        # keep tokens in case item not found
+                    self.pin(start + numtokens)
+                failure, nt = self.parse_item(start + numtokens, item, level + 1)
+                if optional:
+                    self.unpin(start + numtokens)
 
                 if failure:     # wrong item
                     if item.quantifier in '?*':     # zero repetitions allowed
@@ -229,7 +1230,7 @@ class SyntaxParser:
                     if item.quantifier in '+*':
                     
                         # more than one repetition allowed, try parsing more
-                        while start + numtokens < len(self.tokens):
+                        while not self.at_end(start + numtokens):
                         
                             if item.separator:
                                 token = self.tokens[start + numtokens]
@@ -238,7 +1239,11 @@ class SyntaxParser:
                                 else:
                                     break       # no separator, no repeat
 
-                            failure, nt = self.parse_item(start + numtokens, item, qnode)
+                            if self.pinned:         # keep tokens in case no repetition
+                                self.pin(start + numtokens)
+                            failure, nt = self.parse_item(start + numtokens, item, level + 1)
+                            if self.pinned:
+                                self.unpin(start + numtokens)
                             if failure:                 # no more repetitions of item
                                 failure = None              # OK, repetition optional
                                 break
@@ -250,51 +1255,215 @@ class SyntaxParser:
         return failure, numtokens
     
     
-    def parse_item(self, start, item, node):
-        """ Parse tokens from index start using syntax of item; store parse tree in node. 
+    def parse_item(self, start, item, level):
+        """ Parse tokens from index start using syntax of item, at level of tree.
             Return parse item that failed (or None), number of tokens parsed.
         """
-        numtokens = 0           # number of tokens matching syntax
-        if start == len(self.tokens):
-            return item, numtokens          # fail: no tokens left
-        token = self.tokens[start]
-        node.set_location(token)
-        
+        if self.at_end(start):
+            return item, 0                  # fail: no tokens left
         if item.isterminal():
-            # literal item matches token text; tokenkind matches token name
-            match_text = token.text if item.isliteral() else token.name
-            if match_text == item.text():
-                numtokens = 1
-                failure = None
-                if token.text and not item.isliteral():
-                    # don't output NEWLINE, INDENT, DEDENT, or literals
-                    node.add_child(token)   # terminal node
+            return self.parse_terminal(start, item, level)
+        nonterm = self.syntax.nonterms[item.text()]
+        entry = self.memo and self.reuse(start, nonterm, level)
+        if entry:
+            return entry
+        failure, numtokens = self.parse_nonterm(start, nonterm, level + 1)
+        if self.memo:
+            self.memo.store(start, nonterm, failure, numtokens)
+        return failure, numtokens
+
+
+    def parse_terminal(self, start, item, level):
+        """ Match token at index start with terminal item, at level of tree:
+                a literal item matches token text; a tokenkind matches token name.
+            Return parse item that failed (or None), number of tokens parsed.
+        """
+        token = self.tokens[start]
+        match_text = token.text if item.isliteral() else token.name
+        if match_text == item.text():
+            if self.tracer.sinks:
                 if self.newtoken:
-                    self.log(3, token)      # if token display pending, show this one
-                self.log(5, '    %s found' % item, node)
-                self.newtoken = True    # show next token in trace
-                numtokens += self.parse_comments(start + numtokens, node)
+                    self.trace('token', (token,))   # if token display pending, show this one
+                self.trace('found', (item,), level, start)
+            self.newtoken = True    # show next token in trace
+            self.parse_comments(token.trailing)
+            return None, 1
+        else:
+            if self.tracer.sinks:
+                self.trace('not found', (item,), level, start)
+            return item, 0          # item not found
+
+
+    def reuse(self, start, nonterm, level):
+        """ Return memo entry of nonterm parsed from index start, or None."""
+        entry = self.memo.get(start, nonterm)
+        if entry:
+            failure, numtokens = entry
+            if self.tracer.sinks:
+                self.trace('memo', (nonterm, numtokens, failure), level, start)
+            if not failure:
+                self.newtoken = True
+        return entry
+
+
+    def parse_stack(self, start, nonterm, level):
+        """ Parse tokens from index start using syntax of nonterm, at level of tree,
+                as parse_nonterm does, but with an explicit stack of Frames
+                instead of recursive calls, so depth of syntax is not limited.
+            Each frame parses its alternates in turn, as parse_alt does;
+                to parse a nonterm item, a frame is pushed, and popped when closed.
+            Return parse item that failed (or None), number of tokens parsed.
+        """
+        stack = []              # frames waiting for parse of a nonterm item
+        nonterms = self.syntax.nonterms
+        at_end = self.at_end
+        pinned = self.pinned
+        memo = self.memo
+        sinks = self.tracer.sinks
+        frame = self.open_frame(start, nonterm, level)
+        alt = None              # alternate being parsed by frame (progress kept in locals,
+        itemindex = 0           #   saved in frame while a nonterm item is parsed)
+        numtokens = 0
+        repeat = False
+        result = None           # (failure, number of tokens) of nonterm item just parsed
+        while True:
+            if result is None:
+                if alt is None:                 # start next alternate, or close frame
+                    if frame.done or frame.altindex == len(frame.alts):
+                        result = self.close_frame(frame)
+                        if not stack:
+                            return result
+                        if memo:
+                            memo.store(frame.start, frame.nonterm, *result)
+                        frame = stack.pop()
+                        alt, itemindex = frame.alt, frame.itemindex
+                        numtokens, repeat = frame.numtokens, frame.repeat
+                        continue
+                    alt = frame.alts[frame.altindex]
+                    if sinks:
+                        self.trace('alternate', (frame.nonterm, alt), frame.level, frame.start)
+                    itemindex = numtokens = 0
+                    repeat = False
+                
+                items = alt.items
+                if itemindex == len(items):     # alternate parsed
+                    frame.done = self.end_alt(frame, alt, None, numtokens)
+                    frame.altindex += 1
+                    alt = None
+                    continue
+                
+                # parse item (quantified items: as in parse_alt)
+                item = items[itemindex]
+                index = frame.start + numtokens
+                itemlevel = frame.level
+                if item.quantifier != '1':
+                    itemlevel += 1
+                    if pinned and (repeat or item.quantifier in '?*'):
+                        self.pin(index)     # keep tokens in case item not found
+                if at_end(index):
+                    failure, nt = item, 0
+                elif item.isterminal():
+                    failure, nt = self.parse_terminal(index, item, itemlevel)
+                else:
+                    nonterm = nonterms[item.text()]
+                    entry = memo and self.reuse(index, nonterm, itemlevel)
+                    if not entry:
+                        frame.alt, frame.itemindex = alt, itemindex
+                        frame.numtokens, frame.repeat = numtokens, repeat
+                        stack.append(frame)
+                        frame = self.open_frame(index, nonterm, itemlevel + 1)
+                        alt = None
+                        continue
+                    failure, nt = entry
+            
+            else:       # nonterm item parsed by frame popped
+                failure, nt = result
+                result = None
+                item = alt.items[itemindex]
+                index = frame.start + numtokens
+            
+            # item parsed: continue alternate
+            quantifier = item.quantifier
+            if quantifier == '1':
+                numtokens += nt
+                next_item = not failure
             else:
-                self.log(5, '    %s not found' % item, node)
-                failure = item      # item not found
+                if pinned and (repeat or quantifier in '?*'):
+                    self.unpin(index)
+                if failure:
+                    if quantifier in '?*' or repeat:
+                        failure = None          # zero repetitions, or no more
+                    else:
+                        numtokens += nt         # item required, location of failure
+                    next_item = not failure
+                else:
+                    numtokens += nt
+                    next_item = quantifier == '?'
+                    if not next_item:           # try parsing another repetition
+                        index = frame.start + numtokens
+                        if at_end(index):
+                            next_item = True
+                        elif item.separator:
+                            if self.tokens[index].text == item.separator:
+                                numtokens += 1
+                            else:
+                                next_item = True    # no separator, no repeat
+                repeat = not next_item and not failure
             
-        else:   # nonterminal
-            nonterm = self.syntax.nonterms[item.text()]
-            nonterm_node = node.add_child(nonterm.name)
-            failure, numtokens = self.parse_nonterm(start, nonterm, nonterm_node)
-            if failure:
-                node.remove_child()
-        return failure, numtokens
+            if failure:     # wrong item, alternate fails
+                frame.done = self.end_alt(frame, alt, failure, numtokens)
+                frame.altindex += 1
+                alt = None
+            elif next_item:
+                itemindex += 1
 
 
-    def log(self, msgtype, message, node=None):
-        if str(msgtype) in self.debug:
-            indent = node.indent() if node else ''
-            print indent + str(message)
+    def trace(self, kind, args=(), level=None, index=None):
+        """ Send event of kind (see tracing.kinds) with args to sinks of self.tracer,
+                at level of tree with position of token at index, if given.
+            (Caller tests self.tracer.sinks first, so tracing costs nothing when off.)"""
+        position = None
+        if index is not None:
+            position = self.tokens[index].position
+        self.tracer.emit(kind, args, level, position)
 
-        
-def listtokens(tokens):
-    return ' '.join(map(str, tokens))
+
+worker_parser = None            # SyntaxParser of a parse_parallel() worker process
+
+def init_worker(parser):
+    """ Keep parser (with tokens being parsed) for worker process of parse_parallel()
+        (the parser is inherited, not copied, when the process is forked)."""
+    global worker_parser
+    worker_parser = parser
+
+
+def parse_chunk(chunk):
+    """ Parse occurrences of chunk (start, end) of tokens in worker process,
+        return result of SyntaxParser.parse_occurrences."""
+    return worker_parser.parse_occurrences(*chunk)
+
+
+def merge_occurrences(results):
+    """ Merge occurrences parsed in chunks (iterable of results of parse_chunk, in order
+            of chunks): those of a chunk before the index where the previous chunk's
+            last occurrence ended are dropped.
+        Return (list of nodes of occurrences, list of their token indices, number of
+            tokens parsed), or None if a chunk failed or a split was within an occurrence.
+    """
+    nodes = []
+    starts = []
+    end = 0                 # index after last occurrence merged
+    for occurrences in results:
+        if occurrences is None:
+            return None
+        for start, numtokens, node in occurrences:
+            if start > end:
+                return None
+            if start == end:
+                nodes.append(node)
+                starts.append(start)
+                end += numtokens
+    return nodes, starts, end
 
 
 parser = None
@@ -303,12 +1472,14 @@ def test(source_filepath, grammar_dir=None, debug=''):
     global parser
     if grammar_dir == None:
         grammar_dir = 'modspecs/'
-    srcname, sep, langname = source_filepath.rpartition('.')
+    srcname, sep, langname = uncompressed_path(source_filepath).rpartition('.')
     tree = None
     try:
         print '\nParsing %s ... \n' % source_filepath
         parser = SyntaxParser(os.path.join(grammar_dir, langname), debug)
-        tree = parser.parse(source_filepath, enable_imports=('m' in debug))
+        processes = multiprocessing.cpu_count() if 'x' in debug else 1
+        tree = parser.parse(source_filepath, enable_imports=('m' in debug),
+                                stream=('l' in debug), processes=processes)
         print "\n**** Syntax test done ****"
     except (None if 'b' in debug else Error) as exc:
         print exc
@@ -348,12 +1519,21 @@ if __name__ == '__main__':
         5 = parse trace: show tokens found and not found
         a = ambiguous parse permitted (error suppressed)
         b = show traceback on error
+        c = memoize parses of nonterms (packrat parsing)
+        f = ordered choice: keep first successful alternate (unless nonterm is .longest)
+        h = profile parse: table of costs of nonterms and alternates, most time first
+        j = profile parse: costs of nonterms and alternates as JSON
+        k = parse without bracket index (try alternates in any region)
+        l = stream tokens to parser as needed (o, r ignored)
         m = enable imports in source files
         n = use with t, 3, 4, or 5 to show line and column numbers
         o = list tokens from source file
         p = list possible prefixes for syntax nonterminals
+        q = parse without lookahead tries (try alternates that any first token allows)
         r = display source code reassembled from tokens
         s = display syntax used to parse source
         t = display parse tree
+        u = parse with explicit stack (no recursion limit on nesting of syntax)
+        x = parse top-level items in parallel, one process per cpu (ignored with l)
         """ % sys.argv[0]
 
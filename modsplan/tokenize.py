@@ -5,21 +5,63 @@
 # Copyright 2011-2013 by David H Post, DaviWorks.com.
 
 
+import bisect
+import json
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from timeit import default_timer as timer
+
 import grammar
-from lineparsers import LineInfoParser, FileParser, Error
+import scanner
+import tracing
+from lineparsers import LineInfoParser, FileParser, IndentParser, TextParser, Error, Location
+from lineparsers import locations, uncompressed_path
+
+
+comment_kind = 'COMMENT'        # tokens of this kind are trivia of neighboring tokens
 
 
-class Token:
+class Token(object):
     """ One symbol from source text; 
-        for example: keyword, identifier, operator, punctuation, number."""
+        for example: keyword, identifier, operator, punctuation, number.
+        Comments are not tokens of the sequence: they are kept as trivia,
+            in leading (comments before first token) or trailing (comments after token).
+    """
+    leading = ()                # comment tokens preceding this token (first token only)
+    trailing = ()               # comment tokens following this token
+    prefix_mask = (None, 0)     # (grammar, bits of its terminals matched), cached by
+                                #   syntax.SyntaxParser.open_frame (see SyntaxGrammar.token_mask)
     
     def __init__(self, name, text, location, column, tabsize):
         self.name = name                    # name for the kind (the category) of the token
         self.text = text                    # string of chars from source
-        self.location = location.copy()    
-            # lineparsers.Location (filepath, linenum, column, etc)
-        self.location.column = column       # column number of first char of token in source
-        self.location.tabsize = tabsize     # used to expand tabs to display containing line
+        self.position = locations.position(location, column, tabsize)
+            # packed location of first char of token (see lineparsers.LocationTable)
+    
+    @classmethod
+    def at(cls, name, text, position):
+        """ Return token with given packed position."""
+        token = cls.__new__(cls)
+        token.name = name
+        token.text = text
+        token.position = position
+        return token
+    
+    @property
+    def location(self):
+        """ lineparsers.Location (filepath, linenum, column, etc), built when needed."""
+        return locations.location(self.position)
+    
+    def __getstate__(self):
+        """ Pickle position as a state of its file and fields (see LocationTable.state)."""
+        state = dict(self.__dict__, position=locations.state(self.position))
+        state.pop('prefix_mask', None)      # (keeps the grammar)
+        return state
+    
+    def __setstate__(self, state):
+        state['position'] = locations.restore(state['position'])
+        self.__dict__.update(state)
     
     def __str__(self):
         """ If no text, return name. If no name, return quoted text.
@@ -33,6 +75,283 @@ class Token:
         return result
 
 
+class TokenStream(object):
+    """ Compact sequence of tokens: kinds, texts, line numbers, etc. are stored in
+            parallel arrays, with kind names and texts interned in one string table.
+        Indexing returns a Token, built when needed (recently used ones are cached).
+    """
+    cache_size = 16384          # maximum number of Tokens cached
+
+    def __init__(self, tabsize=4):
+        self.tabsize = tabsize      # used to expand tabs to display containing line
+        self.strings = []           # interned kind names and texts
+        self.string_ids = {}        # string_ids[string] is index of string in strings
+        self.files = []             # (filepath, lines, locations fileid) for each file
+        self.file_ids = {}          # file_ids[(filepath, id(lines))] is index in files
+        self.kinds = array('i')     # index in strings of kind name of each token
+        self.texts = array('i')     # index in strings of text of each token
+        self.fileids = array('i')   # index in files of each token
+        self.linenums = array('i')  # line number of each token
+        self.levels = array('i')    # indentation level of line of each token
+        self.columns = array('i')   # column number of each token
+        self.indent_linenum = 0     # line number of first indented line (0 if none)
+        self.leading = []           # comment tokens before first token
+        self.trailing = {}          # trailing[index] is list of comment tokens after index
+        self.views = {}             # views[index] is Token built for index
+        self.spliced = []           # (start, end, number of new tokens) of each splice
+
+    def intern(self, string):
+        """ Return index of string in string table, adding it if new."""
+        index = self.string_ids.get(string)
+        if index is None:
+            index = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+    def append(self, name, text, location, column):
+        """ Add token of kind name, with text, at location (line) and column.
+            A comment is added to trivia of previous token."""
+        if name == comment_kind:
+            comment = Token(name, text, location, column, self.tabsize)
+            if self.kinds:
+                self.trailing.setdefault(len(self.kinds) - 1, []).append(comment)
+            else:
+                self.leading.append(comment)
+            return
+        kind, text, fileid, linenum, level, column = self.fields(name, text, location, column)
+        self.kinds.append(kind)
+        self.texts.append(text)
+        self.fileids.append(fileid)
+        self.linenums.append(linenum)
+        self.levels.append(level)
+        self.columns.append(column)
+        if level and not self.indent_linenum:
+            self.indent_linenum = linenum
+
+    def fields(self, name, text, location, column):
+        """ Return tuple of array values for token (see append)."""
+        key = (location.filepath, id(location.lines))
+        fileid = self.file_ids.get(key)
+        if fileid is None:
+            fileid = self.file_ids[key] = len(self.files)
+            self.files.append((location.filepath, location.lines,
+                                locations.file_id(location.filepath, location.lines,
+                                                    self.tabsize)))
+        return (self.intern(name), self.intern(text), fileid,
+                    location.linenum, location.level, column)
+
+    def splice(self, start, end, tokens, shift=0, linerange=None):
+        """ Replace tokens start:end with tokens, an iterable of
+                (name, text, location, column) as for append;
+            add shift to line numbers of the tokens that follow them.
+            linerange is (first, end) line numbers of lines replaced (end excluded,
+                None for end of source); comments on those lines are replaced too.
+        """
+        arrays = (self.kinds, self.texts, self.fileids,
+                    self.linenums, self.levels, self.columns)
+        rows = [array('i') for values in arrays]
+        
+        # Comments from previous token to token at end: keep those outside linerange
+        anchor = self.trailing.pop(start - 1, []) if start else self.leading
+        comments = anchor[:]
+        for index in xrange(start, end):
+            comments += self.trailing.pop(index, [])
+        first, last = linerange or (0, 0)
+        del anchor[:]
+        after = []          # comments on lines following linerange
+        for comment in comments:
+            linenum = locations.unpack(comment.position)[1]
+            if linenum < first:
+                anchor.append(comment)
+            elif last is not None and linenum >= last:
+                shift_lines(comment, shift)
+                after.append(comment)
+        
+        trivia = {}         # trivia[index] is comments following new token index
+        trailing = anchor
+        for name, text, location, column in tokens:
+            if name == comment_kind:
+                trailing.append(Token(name, text, location, column, self.tabsize))
+            else:
+                for row, value in zip(rows, self.fields(name, text, location, column)):
+                    row.append(value)
+                trailing = trivia.setdefault(start + len(rows[0]) - 1, [])
+        trailing += after
+        if anchor:
+            if start:
+                self.trailing[start - 1] = anchor
+        
+        # Renumber trivia of tokens that follow
+        offset = len(rows[0]) - (end - start)
+        if offset or shift:
+            following = dict((index, comments) for index, comments in self.trailing.items()
+                                if index >= end)
+            for index, comments in following.items():
+                del self.trailing[index]
+                for comment in comments:
+                    shift_lines(comment, shift)
+            for index, comments in following.items():
+                self.trailing[index + offset] = comments
+        self.trailing.update((index, comments) for index, comments in trivia.items()
+                                if comments)
+        
+        if shift:
+            self.linenums[end:] = array('i', [linenum + shift
+                                                for linenum in self.linenums[end:]])
+        for values, row in zip(arrays, rows):
+            values[start:end] = row
+        self.spliced.append((start, end, len(rows[0])))
+        self.views.clear()
+        self.indent_linenum = 0
+        for index, level in enumerate(self.levels):
+            if level:
+                self.indent_linenum = self.linenums[index]
+                break
+
+    def set_lines(self, lines, fileid=0):
+        """ Replace lines of text of file fileid (after source is edited);
+            its id in locations is kept, so positions of tokens are unchanged."""
+        filepath, oldlines, locid = self.files[fileid]
+        del self.file_ids[(filepath, id(oldlines))]
+        self.file_ids[(filepath, id(lines))] = fileid
+        self.files[fileid] = (filepath, lines, locid)
+        locations.set_lines(locid, lines)
+
+    def comments(self):
+        """ Return list of all comment tokens (trivia), in order."""
+        comments = list(self.leading)
+        for index in sorted(self.trailing):
+            comments += self.trailing[index]
+        return comments
+
+    def kindnames(self):
+        """ Return list of kind names of tokens."""
+        strings = self.strings
+        return [strings[kind] for kind in self.kinds]
+
+    def tokentexts(self):
+        """ Return list of texts of tokens."""
+        strings = self.strings
+        return [strings[text] for text in self.texts]
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        """ Return Token at index, or list of Tokens for a slice."""
+        try:
+            return self.views[index]
+        except KeyError:
+            pass
+        except TypeError:       # slice
+            views = self.views
+            return [views.get(i) or self[i] for i in xrange(*index.indices(len(self)))]
+        token = self.views.get(index)
+        if token is None:
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('Token index out of range')
+            token = self.view(index)
+            if len(self.views) >= self.cache_size:
+                self.views.clear()
+            self.views[index] = token
+        return token
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self.view(index)
+
+    def view(self, index):
+        """ Build Token (with its packed position) for token at index."""
+        position = locations.pack(self.files[self.fileids[index]][2], self.linenums[index],
+                                    self.levels[index], self.columns[index])
+        strings = self.strings
+        token = Token.at(strings[self.kinds[index]], strings[self.texts[index]], position)
+        if index in self.trailing:
+            token.trailing = self.trailing[index]
+        if index == 0 and self.leading:
+            token.leading = self.leading
+        return token
+
+
+def shift_lines(token, shift):
+    """ Add shift to line number of token's position."""
+    fileid, linenum, level, column = locations.unpack(token.position)
+    token.position = locations.pack(fileid, linenum + shift, level, column)
+
+
+class MatchStats(object):
+    """ Costs of matching token kinds, counted by an instrumented Tokenizer:
+            for each kind: match attempts, successes, wasted chars, and time;
+            for each char class: tokens starting with it, and kinds attempted.
+        Wasted chars are chars scanned by a kind whose match was not the token found,
+            including chars scanned before its match failed.
+        The match memo is cleared before each attempt, so the time and chars
+            counted for a kind do not depend on which kinds were tried before it.
+    """
+    fields = ['attempts', 'successes', 'wasted', 'time']
+
+    def __init__(self, tokendef):
+        self.tokendef = tokendef
+        self.kinds = OrderedDict((kind.name, dict.fromkeys(self.fields, 0))
+                                    for kind in tokendef.kinds)
+        self.starts = {}            # starts[charclass] is number of tokens starting there
+        self.attempts = {}          # attempts[charclass] is number of kind matches tried
+
+    def count_start(self, chrclass, numkinds):
+        self.starts[chrclass] = self.starts.get(chrclass, 0) + 1
+        self.attempts[chrclass] = self.attempts.get(chrclass, 0) + numkinds
+
+    def count_attempt(self, kindname, seconds):
+        counts = self.kinds[kindname]
+        counts['attempts'] += 1
+        counts['time'] += seconds
+
+    def count_success(self, kindname):
+        self.kinds[kindname]['successes'] += 1
+
+    def count_waste(self, kindname, numchars):
+        self.kinds[kindname]['wasted'] += numchars
+
+    def conflicts(self):
+        """ Return list of (charclass, kindnames) for char classes that
+            more than one kind can start with, most kinds first."""
+        conflicts = [(chrclass, [kind.name for kind in kinds])
+                        for chrclass, kinds in self.tokendef.prefix_map.items()
+                        if len(kinds) > 1]
+        conflicts.sort(key=lambda (chrclass, kindnames): (-len(kindnames), chrclass))
+        return conflicts
+
+    def report(self):
+        """ Return dict of counts: by kind, and for conflicting char classes."""
+        classes = OrderedDict()
+        for chrclass, kindnames in self.conflicts():
+            classes[chrclass] = OrderedDict([('kinds', kindnames),
+                                             ('starts', self.starts.get(chrclass, 0)),
+                                             ('attempts', self.attempts.get(chrclass, 0))])
+        return OrderedDict([('kinds', self.kinds), ('conflicts', classes)])
+
+    def json(self):
+        """ Return report as JSON text."""
+        return json.dumps(self.report(), indent=2)
+
+    def table(self):
+        """ Return report as text table."""
+        text = '\nMatch costs by token kind:\n'
+        text += '%-16s %10s %10s %10s %10s\n' % ('kind', 'attempts', 'successes',
+                                                'wasted', 'time (ms)')
+        for name, counts in self.kinds.items():
+            text += '%-16s %10d %10d %10d %10.1f\n' % (name, counts['attempts'],
+                        counts['successes'], counts['wasted'], counts['time'] * 1000)
+        text += '\nChar classes with competing kinds:\n'
+        text += '%-5s %10s %10s   %s\n' % ('class', 'starts', 'attempts', 'kinds')
+        for chrclass, counts in self.report()['conflicts'].items():
+            text += '%-5s %10d %10d   %s\n' % (chrclass, counts['starts'], counts['attempts'],
+                                                ' '.join(counts['kinds']))
+        return text
+
+
 class TokenGrammar(grammar.Grammar):
     """ Defines token syntax, kinds of tokens. Token definitions read from file."""
     
@@ -101,15 +420,73 @@ class Tokenizer:
     """ Configurable tokenizer. Reads a token specification grammar,
         then parses source text into tokens, as defined by the grammar.
     """
-    def __init__(self, grammar_filename):
+    def __init__(self, grammar_filename, reference=False, instrument=False, tracer=None):
         """ Create tokenizer from grammar file (format defined in tokens.metagrammar).
             The grammar defines the syntax and kinds of tokens.
             If grammar contains 'use' directives, import all needed files.
             To use multiple grammar files, create one file of 'use' directives.
             Grammar commands may enable emitting of NEWLINE, INDENT & DEDENT tokens.
+            Tokens are found with a DFA compiled from the grammar (see scanner.py);
+                if reference, or grammar cannot be compiled, match_token() is used.
+            If instrument, each kind is matched in turn (as by match_token()),
+                and costs are counted in self.stats (see MatchStats).
+            Matching by the reference matcher is traced by tracer (see tracing.Tracer).
         """
+        self.grammar_filename = grammar_filename
+        self.reference = reference
         self.tokendef = TokenGrammar(grammar_filename)  # load token definitions
         self.sourcepath = None          # set in get_tokens()
+        self.memo = {}                  # match_nonterm() lengths, keyed by (pos, nonterm)
+        self.memo_text = None           # text memoized in self.memo
+        self.scan_end = 0               # end of chars scanned, if instrumented
+        self.stats = None               # MatchStats, if instrumented
+        self.tracer = tracer or tracing.Tracer()    # tracing is off unless it has sinks
+        self.keywords = self.find_keywords()
+            # keywords[kindname][text] is keyword kind of token of kindname with text
+        self.scanner = None             # DFAScanner, or None to use reference matcher
+        if not reference:
+            try:
+                self.scanner = scanner.DFAScanner(self.tokendef)
+            except scanner.Unsupported:
+                pass                    # use reference matcher
+        if instrument:
+            self.stats = MatchStats(self.tokendef)
+            self.match = self.match_counted
+        else:
+            self.match = self.scanner.match if self.scanner else self.match_token
+            # match(line, col) finds longest token at col, returns (length, kindname)
+
+
+    def find_keywords(self):
+        """ Find keyword kinds: each alternate is one literal, beginning with a letter,
+                that a (non-keyword) word kind, such as NAME, matches in full.
+            Remove keyword kinds from tokendef.prefix_map, so they are not matched:
+                tokens of a word kind are reclassified by text instead (see lex_line).
+            Return dict: keywords[word kindname][text] is keyword kindname.
+        """
+        candidates = []
+        for kind in self.tokendef.kinds:
+            if all(len(alt.items) == 1 and alt.items[0].isliteral() and
+                        alt.items[0].quantifier == '1' and alt.items[0].text()[:1].isalpha()
+                    for alt in kind.alternates):
+                candidates.append(kind)
+        wordkinds = [kind for kind in self.tokendef.kinds if kind not in candidates]
+        keywords = {}
+        for kind in candidates:
+            words = {}          # words[text] is word kind matching text
+            for alt in kind.alternates:
+                text = alt.items[0].text()
+                for wordkind in wordkinds:      # first kind to match, as in match_token
+                    if self.match_nonterm(text, 0, wordkind) == len(text):
+                        words[text] = wordkind.name
+                        break
+            if len(words) == len(kind.alternates):
+                for text, wordname in words.items():
+                    keywords.setdefault(wordname, {}).setdefault(text, kind.name)
+                for kinds in self.tokendef.prefix_map.values():
+                    if kind in kinds:
+                        kinds.remove(kind)
+        return keywords
 
 
     def prefixes(self):
@@ -120,89 +497,377 @@ class Tokenizer:
         return text + '\n'
 
 
-    def get_tokens(self, sourcepath, tabsize=4, enable_imports=False):
-        """ Tokenize source from sourcepath, return a list of Token.
+    def get_tokens(self, sourcepath, tabsize=4, enable_imports=False, processes=1):
+        """ Tokenize source from sourcepath, return a TokenStream (a sequence of Token).
+            tabsize is # of spaces per tab char, to report accurate column #s.
+            If imports enabled, source may import other source files.
+            If processes > 1, lines are tokenized in parallel by that many processes.
+        """
+        if processes > 1:
+            scan = self.scan_parallel(sourcepath, tabsize, enable_imports, processes)
+        else:
+            scan = self.scan(sourcepath, tabsize, enable_imports)
+        return self.collect_tokens(scan, tabsize)
+
+
+    def get_tokens_from(self, source, name='<string>', tabsize=4):
+        """ Tokenize source: a string, or an iterable of lines (such as a file object);
+                name is used as filepath of token locations (e.g. in error messages).
+            Return a TokenStream, as for get_tokens().
+        """
+        return self.collect_tokens(self.scan_from(source, name, tabsize), tabsize)
+
+
+    def collect_tokens(self, scan, tabsize):
+        """ Return TokenStream of tokens from scan, a generator as from scan()."""
+        tokens = TokenStream(tabsize)
+        for name, text, location, column in scan:
+            tokens.append(name, text, location, column)
+        return tokens
+
+
+    def generate_tokens(self, sourcepath, tabsize=4, enable_imports=False):
+        """ Generator of tokens from source at sourcepath, read as needed.
+            tabsize is # of spaces per tab char, to report accurate column #s.
+            If imports enabled, source may import other source files.
+        """
+        return self.gather_trivia(self.scan(sourcepath, tabsize, enable_imports), tabsize)
+
+
+    def generate_tokens_from(self, source, name='<string>', tabsize=4):
+        """ Generator of tokens from source (a string, or an iterable of lines),
+                read as needed; name is used as filepath of token locations.
+        """
+        return self.gather_trivia(self.scan_from(source, name, tabsize), tabsize)
+
+
+    def gather_trivia(self, scan, tabsize):
+        """ Generator of tokens from scan, a generator as from scan();
+            comments are added to trivia of tokens (see Token).
+        """
+        leading = []            # comments before first token
+        previous = None         # token to yield when its trailing comments are known
+        for name, text, location, column in scan:
+            token = Token(name, text, location, column, tabsize)
+            if name == comment_kind:
+                if previous:
+                    previous.trailing += (token,)
+                else:
+                    leading.append(token)
+            else:
+                if previous:
+                    yield previous
+                else:
+                    token.leading = leading
+                previous = token
+        if previous:
+            yield previous
+
+
+    def scan(self, sourcepath, tabsize=4, enable_imports=False):
+        """ Generator of (kindname, text, location, column) for tokens of source.
+            location is the Location of the current line (changes as lines are read).
             tabsize is # of spaces per tab char, to report accurate column #s.
             If imports enabled, source may import other source files.
         """
         self.sourcepath = sourcepath
-        enable_newline = 'newline' in self.tokendef.options
         enable_indent = 'indent' in self.tokendef.options
         lineparser = LineInfoParser if enable_imports else FileParser
         lines = lineparser(sourcepath, track_indent=enable_indent)
+        return self.scan_lines(lines, iter(lines), tabsize)
+
+
+    def scan_from(self, source, name='<string>', tabsize=4):
+        """ Generator of (kindname, text, location, column) for tokens of source,
+                a string or an iterable of lines, as for scan();
+                name is used as filepath of locations.
+        """
+        self.sourcepath = name
+        enable_indent = 'indent' in self.tokendef.options
+        lines = TextParser(source, name, track_indent=enable_indent)
+        return self.scan_lines(lines, iter(lines), tabsize)
+
+
+    def scan_lines(self, lines, source, tabsize, indentlevel=0, close=True):
+        """ Generator of (kindname, text, location, column) for tokens of source,
+                an iterator of lines served by line parser lines.
+            indentlevel is level of line preceding source.
+            If close, end with dedents to close indented blocks.
+        """
+        enable_newline = 'newline' in self.tokendef.options
         
         # Read lines from source, tokenize
-        tokens = []
-        indentlevel = 0
-        
-        for line in lines:
+        for line in source:
             loc = lines.location
-            tokens += self.indents(loc.level - indentlevel, loc, tabsize)
+            for kindname in self.indents(loc.level - indentlevel):
+                yield kindname, '', loc, 1
             indentlevel = loc.level
-            col = 0             # column of line
-            viewcol = 1         # column as viewed in source (1-origin, expand tabs)
-            
-            while col < len(line):
-                char = line[col]
-                chclass = charclass(char)
-                
-                # find longest match among tokenkinds that can begin with this char class
-                kinds = self.tokendef.prefix_map.get(chclass, [])   # empty list if none
-                maxlength = 0           # length of longest token matched
-                kindname = ''           # remember kind of longest token
-                for kind in kinds:
-                    length = self.match_nonterm(line[col:], kind)
-                    if length > maxlength:
-                        maxlength = length
-                        kindname = kind.name
-                        
-                if maxlength > 0:       # match found
-                    text = line[col:col + maxlength]
-                    tokens.append(Token(kindname, text, loc, viewcol, tabsize))
-                    col += maxlength
-                    viewcol += maxlength
-                        
-                else:  # no match found for any kind starting with char
-                    if not char.isspace():          # skip whitespace
-                        tokens.append(Token('', char, loc, viewcol, tabsize))  # punctuation
-                    col += 1
-                    viewcol += tabsize if char == '\t' else 1
-                    
+            linetokens, viewcol = self.lex_line(line, tabsize)
+            for kindname, text, column in linetokens:
+                yield kindname, text, loc, column
             if enable_newline:
-                tokens.append(Token('NEWLINE', '', loc, viewcol, tabsize))     # end of line
+                yield 'NEWLINE', '', loc, viewcol       # end of line
+
+        if close:
+            # close indented blocks
+            for kindname in self.indents(- indentlevel):
+                yield kindname, '', lines.location, 1
 
+
+    def scan_parallel(self, sourcepath, tabsize=4, enable_imports=False, processes=2):
+        """ Generator of (kindname, text, location, column) for tokens of source,
+                as for scan(); lines are tokenized in a pool of processes.
+            Lines are read here, and sent in chunks to the pool; only the file,
+                line number and level of each line are kept, in arrays.
+                INDENT, DEDENT and NEWLINE tokens are added here as results arrive.
+        """
+        self.sourcepath = sourcepath
+        enable_newline = 'newline' in self.tokendef.options
+        enable_indent = 'indent' in self.tokendef.options
+        lineparser = LineInfoParser if enable_imports else FileParser
+        lines = lineparser(sourcepath, track_indent=enable_indent)
+        texts = []
+        files = []                  # a Location of each file read
+        file_ids = {}               # file_ids[(filepath, id(lines))] is index in files
+        line_files = array('i')     # index in files of each line
+        line_linenums = array('i')  # line number of each line
+        line_levels = array('i')    # indentation level of each line
+        for line in lines:
+            loc = lines.location
+            key = (loc.filepath, id(loc.lines))
+            fileid = file_ids.get(key)
+            if fileid is None:
+                fileid = file_ids[key] = len(files)
+                files.append(Location(loc.filepath, loc.lines))
+            texts.append(line)
+            line_files.append(fileid)
+            line_linenums.append(loc.linenum)
+            line_levels.append(loc.level)
+        
+        chunksize = max(len(texts) // (4 * processes), 1)
+        chunks = [(texts[start:start + chunksize], tabsize)
+                    for start in xrange(0, len(texts), chunksize)]
+        pool = multiprocessing.Pool(processes, init_worker,
+                                        (self.grammar_filename, self.reference))
+        try:
+            results = pool.imap(lex_chunk, chunks)
+            indentlevel = 0
+            index = 0                   # index of line in texts
+            for chunk in results:
+                for linetokens, viewcol in chunk:
+                    loc = files[line_files[index]]      # updated for each line
+                    loc.linenum = line_linenums[index]
+                    loc.level = line_levels[index]
+                    index += 1
+                    for kindname in self.indents(loc.level - indentlevel):
+                        yield kindname, '', loc, 1
+                    indentlevel = loc.level
+                    for kindname, text, column in linetokens:
+                        yield kindname, text, loc, column
+                    if enable_newline:
+                        yield 'NEWLINE', '', loc, viewcol       # end of line
+        finally:
+            pool.close()                # (terminate may deadlock while a worker sends)
+            pool.join()
+        
         # close indented blocks
-        tokens += self.indents(- indentlevel, loc, tabsize)
+        for kindname in self.indents(- indentlevel):
+            yield kindname, '', lines.location, 1
+
+
+    def lex_line(self, line, tabsize):
+        """ Tokenize line; return (list of (kindname, text, column), column after line).
+            Columns are as viewed in source (1-origin, tabs expanded to tabsize).
+        """
+        match = self.match
+        keywords = self.keywords
+        linetokens = []
+        col = 0             # column of line
+        viewcol = 1         # column as viewed in source (1-origin, expand tabs)
+        
+        while col < len(line):
+            char = line[col]
+            maxlength, kindname = match(line, col)      # longest token at col
+                    
+            if maxlength > 0:       # match found
+                text = line[col:col + maxlength]
+                if kindname in keywords:
+                    kindname = keywords[kindname].get(text, kindname)
+                linetokens.append((kindname, text, viewcol))
+                col += maxlength
+                viewcol += maxlength
+                    
+            else:  # no match found for any kind starting with char
+                if not char.isspace():          # skip whitespace
+                    linetokens.append(('', char, viewcol))      # punctuation
+                col += 1
+                viewcol += tabsize if char == '\t' else 1
+        return linetokens, viewcol
+
+
+    def retokenize(self, tokens, lines, changes):
+        """ Update TokenStream tokens (from get_tokens, without imports) after source
+                is edited, re-lexing only the changed lines.
+            lines is list of lines of edited source (without line end chars).
+            changes is list of (linenum, removed, added): removed lines starting at
+                line linenum (1-origin) of previous source were replaced by added lines.
+            Each changed range is re-lexed through the next nonblank line,
+                to resync INDENT and DEDENT tokens; line numbers of tokens that
+                follow are shifted. Return tokens (updated in place).
+            The token ranges replaced are listed in tokens.spliced (in order).
+        """
+        if len(tokens.files) > 1:
+            raise Error('Cannot retokenize source with imports')
+        del tokens.spliced[:]
+        if tokens.files:
+            tokens.set_lines(lines)
+            filepath = tokens.files[0][0]
+        else:
+            filepath = self.sourcepath
+        numlines = len(lines)
+        
+        # Line ranges to re-lex: [oldstart, oldend, newstart, newend], end excluded
+        spans = []
+        changed_end = 0         # end of last change in previous source
+        shift = 0               # change in line numbers, from changes so far
+        for linenum, removed, added in sorted(changes):
+            if linenum < changed_end:
+                raise Error('Overlapping changes at line %d' % linenum)
+            changed_end = linenum + removed
+            newstart = linenum + shift
+            shift += added - removed
+            if spans and newstart <= spans[-1][3]:      # merge with previous range
+                span = spans[-1]
+                span[1] = max(span[1], changed_end)
+            else:
+                span = [linenum, changed_end, newstart, 0]
+                spans.append(span)
+            span[3] = span[1] + shift
+            # extend through next nonblank line
+            while span[3] <= numlines and not lines[span[3] - 1].strip():
+                span[3] += 1
+            span[3] = min(span[3] + 1, numlines + 1)
+            span[1] = span[3] - shift
+        
+        enable_indent = 'indent' in self.tokendef.options
+        dedent = tokens.string_ids.get('DEDENT')
+        for oldstart, oldend, newstart, newend in spans:
+            # line numbers of tokens before this range are already updated
+            start = bisect.bisect_left(tokens.linenums, newstart)
+            end = bisect.bisect_left(tokens.linenums, newstart + oldend - oldstart)
+            lineparser = IndentParser(lines, track_indent=enable_indent)
+            lineparser.location.filepath = filepath
+            indentlevel = 0         # level of line preceding range
+            if tokens.indent_linenum and tokens.indent_linenum < newstart:
+                # first indented line (unchanged) sets the indent
+                first = lines[tokens.indent_linenum - 1]
+                lineparser.indent = lineparser.indentation(first)
+                previous = newstart - 1     # find previous nonblank line
+                while not lines[previous - 1].strip():
+                    previous -= 1
+                for line in lineparser.readrange(previous - 1, previous):
+                    indentlevel = lineparser.location.level
+            elif tokens.indent_linenum:
+                newend = numlines + 1       # first indent may change, re-lex to end
+            at_end = newend > numlines
+            if at_end:
+                end = len(tokens)
+                final = end         # closing dedents of previous source follow last line
+                while final > 0 and tokens.kinds[final - 1] == dedent:
+                    final -= 1
+                start = min(start, final)
+            source = lineparser.readrange(newstart - 1, newend - 1)
+            linerange = (newstart, None if at_end else newstart + oldend - oldstart)
+            tokens.splice(start, end, 
+                            self.scan_lines(lineparser, source, tokens.tabsize,
+                                                indentlevel, close=at_end),
+                            (newend - newstart) - (oldend - oldstart), linerange)
+            if at_end:
+                break
         return tokens
 
 
-    def indents(self, change, location, tabsize):
-        """ Return list of indent or dedent tokens, for change in indent level."""
+    def match_token(self, line, col):
+        """ Find longest token at line[col] by matching each token kind that can begin
+                with its char class (reference matcher, slower than DFAScanner).
+            Return (length, kindname); (0, '') if no match.
+        """
+        kinds = self.tokendef.prefix_map.get(charclass(line[col]), [])  # [] if none
+        maxlength = 0           # length of longest token matched
+        kindname = ''           # remember kind of longest token
+        for kind in kinds:
+            length = self.match_nonterm(line, col, kind)
+            if length > maxlength:
+                maxlength = length
+                kindname = kind.name
+        return maxlength, kindname
+
+
+    def match_counted(self, line, col):
+        """ Find longest token at line[col], as match_token() does,
+            counting attempts, successes, wasted chars, and time for each kind.
+        """
+        chrclass = charclass(line[col])
+        kinds = self.tokendef.prefix_map.get(chrclass, [])
+        stats = self.stats
+        stats.count_start(chrclass, len(kinds))
+        maxlength = 0
+        kindname = ''
+        scanned = []            # (kindname, number of chars scanned)
+        for kind in kinds:
+            self.memo = {}          # match each kind from scratch
+            self.memo_text = line
+            self.scan_end = col
+            begin = timer()
+            length = self.match_nonterm(line, col, kind)
+            stats.count_attempt(kind.name, timer() - begin)
+            scanned.append((kind.name, max(self.scan_end, col + length) - col))
+            if length > maxlength:
+                maxlength = length
+                kindname = kind.name
+        for name, numchars in scanned:
+            if name == kindname:
+                stats.count_success(name)
+            else:
+                stats.count_waste(name, numchars)
+        return maxlength, kindname
+
+
+    def indents(self, change):
+        """ Return list of indent or dedent token kinds, for change in indent level."""
         # ignores multiple-level indents (usually a continuation of prev line)
         if change == 1:
-            return [Token('INDENT', '', location, 1, tabsize)]
+            return ['INDENT']
         else:
-            return (- change) * [Token('DEDENT', '', location, 1, tabsize)]
+            return (- change) * ['DEDENT']
 
 
-    def match_nonterm(self, text, nonterm):
-        """ Look for match with nonterm at start of text.
+    def match_nonterm(self, text, pos, nonterm):
+        """ Look for match with nonterm at text[pos:].
             Return number of chars matched (-1 if no match).
+            Results are memoized by (pos, nonterm) for the current text.
         """
-        if '2' in debug:
-            print 'match nonterm %s with "%s":' % (nonterm.name, text)
+        if text is not self.memo_text:      # new text, start new memo
+            self.memo = {}
+            self.memo_text = text
+        key = (pos, nonterm.name)
+        maxchars = self.memo.get(key)
+        if maxchars is not None:
+            return maxchars
+        if self.tracer.sinks:
+            self.tracer.emit('match nonterm', (nonterm.name, text[pos:]))
         maxchars = -1       # length of longest token that matched
         for alt in nonterm.alternates:
-            col = 0             # index to text
+            col = pos           # index to text
             skip = False
             
             for item in alt.items:
                 if item.ischarclass() and item.text() == 'P':       # assumes P*
                     skip = True
                     continue            # on to next item
-                length = self.match_item(text[col:], item, skip)
-                if '2' in debug:
-                    print '   %d chars of "%s" matched %s' % (length, text[col:], item)
+                length = self.match_item(text, col, item, skip)
+                if self.tracer.sinks:
+                    self.tracer.emit('match item', (length, text[col:], item))
                 if length == -1:        # if item fails to match
                     break                   # try next alternate
                 skip &= (length == 0)   # stop skip if literal found
@@ -210,28 +875,32 @@ class Tokenizer:
             else:               # end of alt, it matched
                 if skip:            # P* was last item in alternate,
                     col = len(text)     # so it matches the rest of the text
-                maxchars = max(col, maxchars)   # remember longest of alternates
+                maxchars = max(col - pos, maxchars)     # remember longest of alternates
+        self.memo[key] = maxchars
         return maxchars
 
 
-    def match_item(self, text, item, skip):
-        """ Look for match with item at start of text, return # of chars matched,
+    def match_item(self, text, pos, item, skip):
+        """ Look for match with item at text[pos:], return # of chars matched,
             or -1 if no match. If skip, skip chars until item is found.
         """
-        if text == '':
+        end = len(text)
+        if pos == end:
             return (0 if item.quantifier in '?*' else -1)
         item_text = item.text()
 
         if skip:
             # last item was character class P*, so match any chars before current item
             #   (current item must be a literal, checked when grammar loaded)
-            column = text.find(item_text)
+            column = text.find(item_text, pos)
+            if self.stats:
+                self.scanned_to(end if column == -1 else column + len(item_text))
             if column == -1:
                 return column                       # not found
             else:
-                return column + len(item_text)      # found it, move past it
+                return column - pos + len(item_text)    # found it, move past it
             
-        length = self.match_single(text, item)
+        length = self.match_single(text, pos, item)
         if length == -1:        # not a match
             if item.quantifier in '?*':
                 length = 0          # zero occurrences OK, report a zero length match
@@ -242,42 +911,80 @@ class Tokenizer:
             return length
         if length == 0:                     # zero length match, can't repeat
             return length
-        column = length
+        column = pos + length
 
         # repeat item as quantifier allows
-        while column < len(text):
-            length = self.match_single(text[column:], item)
+        while column < end:
+            length = self.match_single(text, column, item)
             if length <= 0:
-                return column       # done, no more repeats
+                return column - pos     # done, no more repeats
             column += length
             
-            if item.separator and column < len(text):       
+            if item.separator and column < end:       
                 # if item has separator, next char must be separator, or no repeat
+                if self.stats:
+                    self.scanned_to(column + 1)
                 if text[column] == item.separator:
                     column += 1
                 else:
-                    return column   # no separator, done
-        return column
+                    return column - pos     # no separator, done
+        return column - pos
     
     
-    def match_single(self, text, item):
-        """ Match text with single occurence of item, 
+    def match_single(self, text, pos, item):
+        """ Match text[pos:] with single occurence of item, 
             return number of chars matched or -1 if no match."""
         length = -1         # failure unless otherwise determined
         item_text = item.text()
         if item.ischarclass():
-            if item_text == charclass(text[0]):
+            if self.stats:
+                self.scanned_to(pos + 1)
+            if item_text == charclass(text[pos]):
                 length = 1
         elif item.isliteral():
-            if text.startswith(item_text):
+            if text.startswith(item_text, pos):
                 length = len(item_text)
+            if self.stats:
+                self.scanned_to(pos + (length if length > 0 else
+                                    self.literal_scan(text, pos, item_text)))
         else:   # item must be a nonterminal
             nonterm = self.tokendef.nonterms[item_text]
-            length = self.match_nonterm(text, nonterm)
-        if '3' in debug:
-            print '      %d chars of "%s" match %s' % (length, text, item)
+            length = self.match_nonterm(text, pos, nonterm)
+        if self.tracer.sinks:
+            self.tracer.emit('match single', (length, text[pos:], item))
         return length
     
+    
+    def scanned_to(self, end):
+        """ Note that chars of line before end were scanned (if instrumented)."""
+        if end > self.scan_end:
+            self.scan_end = end
+    
+    
+    def literal_scan(self, text, pos, literal):
+        """ Return number of chars of text[pos:] compared with literal before
+            a match failed: chars equal to literal, and the first that differs."""
+        count = 0
+        for char, expected in zip(text[pos:pos + len(literal)], literal):
+            count += 1
+            if char != expected:
+                break
+        return count
+    
+
+worker_tokenizer = None        # Tokenizer of a scan_parallel() worker process
+
+def init_worker(grammar_filename, reference):
+    """ Create tokenizer for worker process of scan_parallel()."""
+    global worker_tokenizer
+    worker_tokenizer = Tokenizer(grammar_filename, reference)
+
+
+def lex_chunk(chunk):
+    """ Tokenize (lines, tabsize) in worker process, return list of results of lex_line."""
+    lines, tabsize = chunk
+    return [worker_tokenizer.lex_line(line, tabsize) for line in lines]
+
 
 def charclass(char):
     """ Return character class of char. See base.metagrammar for character classes."""
@@ -291,6 +998,16 @@ def charclass(char):
         return char     # char is its own class
                 
 
+def with_trivia(tokens):
+    """ Generator of tokens, with their comment tokens (trivia) in source order."""
+    for token in tokens:
+        for comment in token.leading:
+            yield comment
+        yield token
+        for comment in token.trailing:
+            yield comment
+
+
 def reassemble(tokens):
     """ Return a string of tokens in lines similar to the original source."""
     ### Works only for languages using NEWLINE tokens
@@ -298,7 +1015,7 @@ def reassemble(tokens):
     result = ''
     lastkind = 'NEWLINE'
     
-    for token in tokens:
+    for token in with_trivia(tokens):
         kind = token.name
         if kind == 'NEWLINE':
             if lastkind == 'NEWLINE':
@@ -333,10 +1050,14 @@ debug = ''
 def test(source_filepath):
     global t
     try:
-        language = source_filepath.rpartition('.')[-1]
+        language = uncompressed_path(source_filepath).rpartition('.')[-1]
         tokenspec = 'modspecs/%s.tokens' % language
         
-        t = Tokenizer(tokenspec)
+        tracer = tracing.Tracer()
+        if '2' in debug or '3' in debug:
+            tracer.add(tracing.PrintSink(debug))
+        t = Tokenizer(tokenspec, reference=('f' in debug),
+                        instrument=('c' in debug or 'j' in debug), tracer=tracer)
         print t.prefixes(),
         
         print 'prefix_map:'
@@ -344,14 +1065,24 @@ def test(source_filepath):
             kindnames = [kind.name for kind in kinds]
             print '%3s: %s' % (prefix, ' '.join(kindnames))
         print
+        for wordname, words in sorted(t.keywords.items()):
+            print 'keywords of %s: %s' % (wordname, ' '.join(sorted(words)))
+        print
+        if t.scanner:
+            print 'DFA scanner: %d states\n' % t.scanner.numstates()
             
-        tokens = t.get_tokens(source_filepath)
+        processes = multiprocessing.cpu_count() if 'p' in debug else 1
+        tokens = t.get_tokens(source_filepath, processes=processes)
         if 'o' in debug:
             print 'Tokens from ' + source_filepath + ':\n'
-            for tkn in tokens:
+            for tkn in with_trivia(tokens):
                 print tkn   
         
         print reassemble(tokens)
+        if 'c' in debug:
+            print t.stats.table()
+        if 'j' in debug:
+            print t.stats.json()
 
     except (None if 'b' in debug else Error) as exc:
         print exc
@@ -370,8 +1101,12 @@ if __name__ == '__main__':
         
         debug_flags (may be combined, as in -2ob):
 
-        2 = log nonterm matching to stdout
-        3 = log item matching to stdout
+        2 = log nonterm matching to stdout (with f)
+        3 = log item matching to stdout (with f)
         b = show traceback on error
+        c = count match costs by token kind, report as table (matches each kind in turn)
+        f = find tokens with reference matcher, instead of DFA scanner
+        j = count match costs by token kind, report as JSON
         o = list tokens from source file
+        p = tokenize lines in parallel, one process per cpu
         """ % sys.argv[0]
@@ -0,0 +1,145 @@
+# tracing.py
+# Modsplan trace of parsing and lexing
+# Copyright 2013- by David H Post, DaviWorks.com.
+
+
+""" A trace is a sequence of events, sent by a Tracer to each of its sinks.
+    A traced object tests 'if tracer.sinks:' before making an event,
+        so tracing costs one test when no sink is added.
+    An Event keeps the objects traced (nonterm, alternate, tokens, ...);
+        its message is formatted only when a sink displays it.
+
+    Sinks (any object with an emit(event) method may be added):
+        PrintSink       prints messages of events of verbosities in debug flags
+        LoggingSink     sends messages to a logger of the logging module
+        ListSink        keeps events in a list
+        ParseProfile    counts and times parses of nonterms (see profiler.py)
+"""
+
+import logging
+
+import parsetree
+from lineparsers import locations
+
+
+def list_tokens(nonterm, tokens):
+    return '%s: %s' % (nonterm, ' '.join(map(str, tokens)))
+
+
+def memo_entry(nonterm, numtokens, failure):
+    return '%s: memo (%d tokens)' % (nonterm, numtokens)
+
+
+# Kinds of events: kinds[name] is (verbosity, format of message):
+#   a format string for the args of the event, or a function of them.
+#   The verbosity is the debug flag that displays the event
+#   (None for events not displayed, used by sinks such as profiler.ParseProfile).
+kinds = {
+    # syntax parser
+    'begin':        ('3', '\n\n%s trace:\n'),               # parse begins
+    'open':         (None, '%s'),                           # nonterm parse begins
+    'end':          (None, '%s => %s: failure %s, %d tokens'),  # alternate parse ends
+    'close':        (None, '%s => %s: failure %s, %d tokens'),  # nonterm parse ends
+    'token':        ('3', '%s'),                            # token to be parsed
+    'alternate':    ('3', '%s => %s'),                      # alternate of nonterm tried
+    'parsed':       ('4', list_tokens),                     # nonterm parsed tokens
+    'memo':         ('4', memo_entry),                      # nonterm parse found in memo
+    'failed':       ('4', '%s failed: expected %s'),        # nonterm failed at item
+    'unexpected':   ('4', '%s failed: expected one of \n    %s'),  # (prefixes of nonterm)
+    'found':        ('5', '    %s found'),                  # terminal matched token
+    'not found':    ('5', '    %s not found'),
+    'comment':      ('5', 'COMMENT from line %d: %s'),
+    # tokenizer (reference matcher)
+    'match nonterm':    ('2', 'match nonterm %s with "%s":'),
+    'match item':       ('2', '   %d chars of "%s" matched %s'),
+    'match single':     ('3', '      %d chars of "%s" match %s'),
+}
+
+
+class Event(object):
+    """ One event of a trace: kind (a key of kinds), args for its message,
+        and level of parse tree and packed position of token, if any."""
+    __slots__ = ('kind', 'args', 'level', 'position')
+
+    def __init__(self, kind, args=(), level=None, position=None):
+        self.kind = kind
+        self.args = args
+        self.level = level
+        self.position = position
+
+    @property
+    def verbosity(self):
+        return kinds[self.kind][0]
+
+    def message(self):
+        """ Return message of event (may be more than one line)."""
+        form = kinds[self.kind][1]
+        if isinstance(form, str):
+            return form % self.args
+        return form(*self.args)
+
+    __str__ = message
+
+
+class Tracer(object):
+    """ Sends events to sinks. Tracing is off when there are no sinks."""
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+
+    def add(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def remove(self, sink):
+        self.sinks.remove(sink)
+
+    def emit(self, kind, args=(), level=None, position=None):
+        """ Send event to each sink (caller tests self.sinks first)."""
+        event = Event(kind, args, level, position)
+        for sink in self.sinks:
+            sink.emit(event)
+
+
+class PrintSink(object):
+    """ Prints message of each event whose verbosity is in debug flags, indented to
+        its level of parse tree (after line and column numbers, if debug has 'n')."""
+    def __init__(self, debug):
+        self.debug = debug
+        self.show_location = 'n' in debug
+
+    def emit(self, event):
+        verbosity = kinds[event.kind][0]
+        if verbosity and verbosity in self.debug:
+            message = event.message()
+            if event.level is None:
+                print message
+            else:
+                location = None
+                if self.show_location and event.position is not None:
+                    location = locations.location(event.position)
+                for line in message.split('\n'):
+                    print parsetree.indent(event.level, location) + line
+
+
+class LoggingSink(object):
+    """ Logs message of each event whose verbosity is in flags to logger
+        (default 'modsplan'), at loglevel, indented to its level of parse tree."""
+    def __init__(self, logger=None, flags='2345', loglevel=logging.DEBUG):
+        self.logger = logger or logging.getLogger('modsplan')
+        self.flags = flags
+        self.loglevel = loglevel
+
+    def emit(self, event):
+        verbosity = kinds[event.kind][0]
+        if verbosity and verbosity in self.flags and self.logger.isEnabledFor(self.loglevel):
+            indent = '' if event.level is None else parsetree.indent(event.level)
+            self.logger.log(self.loglevel, '%s%s', indent, event)
+
+
+class ListSink(object):
+    """ Keeps events in list self.events."""
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
@@ -5,10 +5,24 @@
 # Copyright 2013- by David H Post, DaviWorks.com.
 
 import unittest
+import bz2
+import gzip
+import json
+import logging
 import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import closing
 
 import modsplan.compiler
 import modsplan.lineparsers
+import modsplan.profiler
+import modsplan.syntax
+import modsplan.tokenize
+import modsplan.tracing
 
 source_dir = 'sample_source'
 
@@ -27,6 +41,20 @@ class TestCompiler(unittest.TestCase):
 #         self.check_import('import_test.L0')
     
     
+    def test_compile_from(self):
+        compiler = modsplan.compiler.Compiler('c1')
+        sourcepath = os.path.join(source_dir, 'squares.c1')
+        expected = compiler.compile(sourcepath)
+        with open(sourcepath) as sourcefile:
+            text = sourcefile.read()
+        self.assertEqual(compiler.compile_from(text, sourcepath), expected)
+        with open(sourcepath) as sourcefile:
+            self.assertEqual(compiler.compile_from(sourcefile, sourcepath), expected)
+        with self.assertRaises(modsplan.lineparsers.Error) as context:
+            compiler.compile_from(['int main()', '{ x = ; }'], 'request')
+        self.assertIn('in request at line 2, column 7\n{ x = ; }', str(context.exception))
+    
+    
     def check_src(self, sourcename):
         """ Compile sourcename from source_dir, check code against previous."""
         sourcepath = os.path.join(source_dir, sourcename)
@@ -56,6 +84,478 @@ class TestCompiler(unittest.TestCase):
             self.assertMultiLineEqual(text, prevtext)
      
 
+class TestLineParsers(unittest.TestCase):
+    """ Run some tests on line parsers."""
+    
+
+    def test_mapped_lines(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            for text in ['', 'a', 'a\n', 'a\r\n\r\nb\rc\n\nd', '\n\r\r\n']:
+                filepath = os.path.join(tempdir, 'lines.txt')
+                with open(filepath, 'wb') as textfile:
+                    textfile.write(text)
+                lines = modsplan.lineparsers.MappedLines(filepath)
+                expected = text.splitlines()
+                self.assertEqual(list(lines), expected)
+                self.assertEqual([lines[i] for i in range(-len(lines), len(lines))],
+                                    expected + expected)
+                self.assertEqual(lines[1:3], expected[1:3])
+            lines.close()
+            self.assertEqual(list(lines), expected)     # mapped again
+            with open(filepath, 'r+b') as textfile:     # rewrite shorter, in place
+                textfile.truncate(1)
+            self.assertRaises(modsplan.lineparsers.Error, lines.__getitem__, 1)
+            self.assertIsNone(lines.mapping)
+        finally:
+            shutil.rmtree(tempdir)
+    
+    
+    def test_file_cache(self):
+        cache = modsplan.lineparsers.file_cache
+        cache.clear()
+        modsplan.tokenize.Tokenizer('modspecs/c1.tokens')
+        misses = cache.misses
+        modsplan.tokenize.Tokenizer('modspecs/L0.tokens')
+        self.assertEqual(cache.misses, misses + 1)          # only L0.tokens read
+        self.assertEqual(cache.hits, 3)                     # expr, float, base
+        lines = cache.lines('modspecs/base.tokens')
+        self.assertIs(cache.lines('modspecs/base.tokens'), lines)
+        self.assertEqual(list(lines), open('modspecs/base.tokens').read().splitlines())
+
+    
+    
+    def test_locations(self):
+        table = modsplan.lineparsers.LocationTable()
+        lines = ['first', '\tsecond']
+        fileid = table.file_id('text', lines, tabsize=4)
+        self.assertEqual(table.file_id('text', lines, tabsize=4), fileid)
+        position = table.pack(fileid, 2, 1, 3)
+        self.assertEqual(table.unpack(position), (fileid, 2, 1, 3))
+        location = table.location(position)
+        self.assertEqual((location.filepath, location.linenum, location.column),
+                            ('text', 2, 3))
+        self.assertEqual(location.line(), '    second')
+        self.assertRaises(modsplan.lineparsers.Error, table.pack, fileid, 1, 0, 1 << 24)
+
+    
+    
+    def test_compressed(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            # L0.tokens imports expr, float and base: compress two of them
+            shutil.copy('modspecs/L0.tokens', tempdir)
+            shutil.copy('modspecs/float.tokens', tempdir)
+            for name, opener in [('expr.tokens.gz', gzip.open),
+                                 ('base.tokens.bz2', bz2.BZ2File)]:
+                with open(os.path.join('modspecs', name.rpartition('.')[0])) as specfile:
+                    with closing(opener(os.path.join(tempdir, name), 'wb')) as packed:
+                        packed.write(specfile.read())
+            sourcepath = os.path.join(source_dir, 'simplepy.L0')
+            packedpath = os.path.join(tempdir, 'simplepy.L0.gz')
+            with open(sourcepath) as sourcefile:
+                with closing(gzip.open(packedpath, 'wb')) as packed:
+                    packed.write(sourcefile.read())
+            tokenizer = modsplan.tokenize.Tokenizer(os.path.join(tempdir, 'L0.tokens'))
+            expected = modsplan.tokenize.Tokenizer('modspecs/L0.tokens').get_tokens(sourcepath)
+            tokens = tokenizer.get_tokens(packedpath)
+            self.assertEqual([describe(token) for token in tokens],
+                                [describe(token) for token in expected])
+            self.assertEqual(tokens[-1].location.line(), expected[-1].location.line())
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestTokenizer(unittest.TestCase):
+    """ Run some tests on tokenizer."""
+    
+
+    def test_scanner(self):
+        self.check_scanner('c1', ['squares.c1', 'gcd.c1', 'diamond_pattern.c1'])
+        self.check_scanner('L0', ['squares.L0', 'simplepy.L0'])
+        self.check_scanner('calc', ['example.calc', 'example2.calc'])
+        self.check_scanner('sbil', ['squares.c1.sbil', 'simplepy.L0.sbil'])
+    
+    
+    def check_scanner(self, langname, sourcenames):
+        """ Check that DFA scanner finds same tokens as reference matcher."""
+        tokenspec = os.path.join('modspecs', langname + '.tokens')
+        dfa = modsplan.tokenize.Tokenizer(tokenspec)
+        reference = modsplan.tokenize.Tokenizer(tokenspec, reference=True)
+        self.assertTrue(dfa.scanner, 'No DFA scanner for %s' % tokenspec)
+        for sourcename in sourcenames:
+            sourcepath = os.path.join(source_dir, sourcename)
+            expected = [describe(token) for token in reference.get_tokens(sourcepath)]
+            found = [describe(token) for token in dfa.get_tokens(sourcepath)]
+            self.assertEqual(found, expected, 'Tokens differ for %s' % sourcepath)
+    
+    
+    def test_keywords(self):
+        # KEYWORD follows SUBPARAGRAPHID, which also matches 's.'
+        tokenizer = modsplan.tokenize.Tokenizer('legispecs/legislation.tokens')
+        sourcepath = 'legispecs/ab106_sections.legislation'
+        kinds = set(token.name for token in tokenizer.get_tokens(sourcepath)
+                        if token.text == 's.')
+        self.assertEqual(kinds, set(['KEYWORD']))
+    
+    
+    def test_match_memo(self):
+        # WORD, SECTIONID and SUBDIVISIONID all begin with digits: '1196.137 ...'
+        tokenspec = 'legispecs/legislation.tokens'
+        with open('legispecs/ab106_sections.legislation') as sourcefile:
+            line = sourcefile.read().splitlines()[1]
+        reference = modsplan.tokenize.Tokenizer(tokenspec, reference=True)
+        sink = reference.tracer.add(modsplan.tracing.ListSink())
+        expected = modsplan.tokenize.Tokenizer(tokenspec).lex_line(line, 4)
+        self.assertEqual(reference.lex_line(line, 4), expected)
+        self.assertIs(reference.memo_text, line)
+        self.assertEqual(reference.memo[(0, 'digits')], 4)
+        matched = [event.args[1] for event in sink.events if event.kind == 'match nonterm'
+                        and event.args[0] == 'digits']
+        tried = [event.args[1] for event in sink.events if event.kind == 'match single'
+                        and event.args[2].text() == 'digits']
+        self.assertEqual(len(matched), len(set(matched)))  # each (pos, nonterm) matched once
+        self.assertGreater(len(tried), len(matched))        # others served from memo
+    
+    
+    def test_instrument(self):
+        tokenizer = modsplan.tokenize.Tokenizer('modspecs/c1.tokens', instrument=True)
+        sourcepath = os.path.join(source_dir, 'gcd.c1')
+        expected = [describe(token) for token in
+                        modsplan.tokenize.Tokenizer('modspecs/c1.tokens').get_tokens(sourcepath)]
+        tokens = tokenizer.get_tokens(sourcepath)
+        self.assertEqual([describe(token) for token in tokens], expected)
+        report = tokenizer.stats.report()
+        self.assertEqual(report['kinds']['ADD_OP']['successes'],
+                         len([token for token in tokens if token.name == 'ADD_OP']))
+        self.assertEqual(report['kinds']['MUL_OP']['wasted'], 2)   # '//' of comments
+        self.assertIn('/', report['conflicts'])
+        tokenizer = modsplan.tokenize.Tokenizer('modspecs/c1.tokens', instrument=True)
+        tokenizer.get_tokens_from('x = a / b;', 'division')
+        report = tokenizer.stats.report()
+        self.assertEqual(report['kinds']['MUL_OP']['successes'], 1)
+        self.assertEqual(report['kinds']['COMMENT']['wasted'], 2)  # failed at ' ' after '/'
+    
+    
+    def test_stream(self):
+        tokenizer = modsplan.tokenize.Tokenizer('modspecs/c1.tokens')
+        sourcepath = os.path.join(source_dir, 'diamond_pattern.c1')
+        tokens = tokenizer.get_tokens(sourcepath)
+        expected = [describe(token) for token in tokenizer.generate_tokens(sourcepath)]
+        self.assertEqual([describe(token) for token in tokens], expected)
+        self.assertEqual([describe(token) for token in tokens[-3:]], expected[-3:])
+        self.assertEqual(tokens[5].location.line(), tokens[5 - len(tokens)].location.line())
+    
+    
+    def test_parallel(self):
+        tokenizer = modsplan.tokenize.Tokenizer('modspecs/L0.tokens')
+        sourcepath = os.path.join(source_dir, 'simplepy.L0')
+        expected = [describe(token) for token in tokenizer.get_tokens(sourcepath)]
+        tokens = tokenizer.get_tokens(sourcepath, processes=2)
+        self.assertEqual([describe(token) for token in tokens], expected)
+    
+    
+    def test_retokenize(self):
+        tokenizer = modsplan.tokenize.Tokenizer('modspecs/L0.tokens')
+        sourcepath = os.path.join(source_dir, 'simplepy.L0')
+        tokens = tokenizer.get_tokens(sourcepath)
+        with open(sourcepath) as sourcefile:
+            lines = sourcefile.read().splitlines()
+        # dedent the else block, replace a line, add lines at end
+        lines[7:10] = [line[4:] for line in lines[7:10]]
+        lines[1] = '    length = 0'
+        lines += ['', 'def int f():', '    return 1']
+        changes = [(2, 1, 1), (8, 3, 3), (12, 0, 3)]
+        tokenizer.retokenize(tokens, lines, changes)
+        editpath = os.path.join(tempfile.mkdtemp(), 'simplepy.L0')
+        with open(editpath, 'w') as editfile:
+            editfile.write('\n'.join(lines))
+        expected = tokenizer.get_tokens(editpath)
+        self.assertEqual([describe(token) for token in tokens],
+                            [describe(token) for token in expected])
+        self.assertEqual(list(tokens.levels), list(expected.levels))
+        shutil.rmtree(os.path.dirname(editpath))
+    
+    
+    def test_trivia(self):
+        sourcepath = os.path.join(tempfile.mkdtemp(), 'trivia.c1')
+        with open(sourcepath, 'w') as sourcefile:
+            sourcefile.write('// squares\nint x; // first\nint y;\n')
+        tokenizer = modsplan.tokenize.Tokenizer('modspecs/c1.tokens')
+        tokens = tokenizer.get_tokens(sourcepath)
+        trivia = [([comment.text for comment in token.leading],
+                   [comment.text for comment in token.trailing]) for token in tokens]
+        self.assertEqual(trivia, [(['// squares'], []), ([], []), ([], ['// first']),
+                                  ([], []), ([], []), ([], [])])
+        tree = modsplan.syntax.SyntaxParser('modspecs/c1').parse(sourcepath)
+        self.assertEqual([comment.text for comment in tree.comments], ['// squares'])
+        declaration = tree.children[0].children[0]      # extdeclaration ending at ';'
+        self.assertEqual([comment.text for comment in declaration.comments], ['// first'])
+        # move the trailing comment to the next line
+        lines = ['// squares', 'int x;', 'int y; // second']
+        tokenizer.retokenize(tokens, lines, [(2, 2, 2)])
+        self.assertEqual([comment.text for comment in tokens[0].leading], ['// squares'])
+        self.assertEqual([index for index, token in enumerate(tokens) if token.trailing],
+                            [5])
+        self.assertEqual([(comment.text, comment.location.linenum)
+                            for comment in tokens.comments()],
+                         [('// squares', 1), ('// second', 3)])
+        shutil.rmtree(os.path.dirname(sourcepath))
+
+
+class TestSyntaxParser(unittest.TestCase):
+    """ Run some tests on syntax parser."""
+    
+
+    def test_stream(self):
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1')
+        sourcepath = os.path.join(source_dir, 'gcd.c1')
+        tree = parser.parse(sourcepath)
+        with open(sourcepath) as sourcefile:
+            text = sourcefile.read()
+        trim_interval = modsplan.syntax.TokenBuffer.trim_interval
+        modsplan.syntax.TokenBuffer.trim_interval = 16
+        try:
+            streamed = parser.parse(sourcepath, stream=True)
+            # occurrences of extdeclaration are built as parsed, then their tokens dropped
+            parser.parse_from(text * 8, sourcepath, stream=True)
+        finally:
+            modsplan.syntax.TokenBuffer.trim_interval = trim_interval
+        self.assertMultiLineEqual(streamed.show(), tree.show())
+        self.assertIsNone(parser.buffer.kept)
+        self.assertEqual(parser.buffer.numread, 8 * len(parser.tokenizer.get_tokens(sourcepath)))
+        self.assertLess(parser.buffer.maxsize, parser.buffer.numread // 8)   # bounded
+        self.assertEqual(parser.derivation, {})
+    
+    
+    def test_memo(self):
+        sourcepath = os.path.join(source_dir, 'diamond_pattern.c1')
+        tree = modsplan.syntax.SyntaxParser('modspecs/c1').parse(sourcepath)
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1', debug='c')
+        self.assertMultiLineEqual(parser.parse(sourcepath).show(), tree.show())
+        self.assertTrue(parser.memo.hits)
+        max_entries = modsplan.syntax.ParseMemo.max_entries
+        modsplan.syntax.ParseMemo.max_entries = 64
+        try:
+            memotree = parser.parse(sourcepath)
+            self.assertLessEqual(len(parser.memo.entries), 64)
+        finally:
+            modsplan.syntax.ParseMemo.max_entries = max_entries
+        self.assertMultiLineEqual(memotree.show(), tree.show())
+    
+    
+    def test_lookahead(self):
+        sourcepath = os.path.join(source_dir, 'diamond_pattern.c1')
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1')
+        tree = modsplan.syntax.SyntaxParser('modspecs/c1', debug='q').parse(sourcepath)
+        self.assertMultiLineEqual(parser.parse(sourcepath).show(), tree.show())
+        syntax = parser.syntax
+        self.assertIn('expression', syntax.conflicts)
+        self.assertNotIn('statement', syntax.conflicts)
+        source = 'int main() { int x = (1 + ; return x; }\n'
+        messages = []
+        for debug in ('', 'q'):
+            parser = modsplan.syntax.SyntaxParser('modspecs/c1', debug=debug)
+            with self.assertRaises(modsplan.lineparsers.Error) as context:
+                parser.parse_from(source)
+            messages.append(str(context.exception))
+        self.assertEqual(messages[0], messages[1])
+    
+    
+    def test_ordered(self):
+        sourcepath = os.path.join(source_dir, 'gcd.c1')
+        tree = modsplan.syntax.SyntaxParser('modspecs/c1').parse(sourcepath)
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1', debug='f')
+        self.assertMultiLineEqual(parser.parse(sourcepath).show(), tree.show())
+        nonterm = parser.syntax.nonterms['return']
+        self.assertTrue(nonterm.longest)
+        nonterm.longest = False         # first alternate, 'return', wins
+        self.assertRaises(modsplan.lineparsers.Error, parser.parse, sourcepath)
+    
+    
+    def test_derivation(self):
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1')
+        tree = parser.parse(os.path.join(source_dir, 'gcd.c1'))
+        root = parser.syntax.root
+        self.assertIs(parser.derivation[(0, root.name)][0], root.alternates[0])
+        rebuilt = modsplan.syntax.parsetree.new(root.name)
+        rebuilt.add_comments(parser.tokens[0].leading)
+        builder = modsplan.syntax.TreeBuilder(parser.syntax, parser.tokens, parser.derivation)
+        self.assertEqual(builder.build(0, root, rebuilt), len(parser.tokens))
+        self.assertMultiLineEqual(rebuilt.show(), tree.show())
+    
+    
+    def test_stack(self):
+        sourcepath = os.path.join(source_dir, 'diamond_pattern.c1')
+        tree = modsplan.syntax.SyntaxParser('modspecs/c1').parse(sourcepath)
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1', debug='u')
+        self.assertMultiLineEqual(parser.parse(sourcepath).show(), tree.show())
+        source = '(' * 400 + '1' + ')' * 400
+        with self.assertRaises(RuntimeError):
+            modsplan.syntax.SyntaxParser('modspecs/calc').parse_from(source)
+        tree = modsplan.syntax.SyntaxParser('modspecs/calc', debug='u').parse_from(source)
+        node, depth = tree, 0
+        while not node.isterminal():        # (tree is too deep to search recursively)
+            depth += node.name == 'parentheses'
+            node = node.children[0]
+        self.assertEqual((depth, node.text), (400, '1'))
+    
+    
+    def test_reparse(self):
+        with open(os.path.join(source_dir, 'gcd.c1')) as sourcefile:
+            lines = ['int count;'] + sourcefile.read().splitlines() + ['int total;']
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1', debug='n')
+        tree = parser.parse_from('\n'.join(lines), 'gcd.c1')
+        first, last = tree.children[0].children[0], tree.children[0].children[-1]
+        lines[17:18] = ['  int d, e;', '  e = 0;']      # edit main
+        numfiles = len(modsplan.lineparsers.locations.files)
+        self.assertIs(parser.reparse(tree, parser.tokens, lines, [(18, 1, 2)]), tree)
+        self.assertEqual(len(modsplan.lineparsers.locations.files), numfiles)  # same file id
+        self.assertEqual(last.location.line(), 'int total;')
+        expected = parser.parse_from('\n'.join(lines), 'gcd.c1')
+        self.assertMultiLineEqual(tree.show(), expected.show())
+        self.assertIs(tree.children[0].children[0], first)      # reused, not parsed again
+        self.assertIs(tree.children[0].children[-1], last)
+        self.assertEqual(last.location.linenum, 23)
+    
+    
+    def test_parallel(self):
+        sourcepath = os.path.join(source_dir, 'gcd.c1')
+        expected = modsplan.syntax.SyntaxParser('modspecs/c1')
+        tree = expected.parse(sourcepath)
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1')
+        parser.chunk_size = 16
+        self.assertMultiLineEqual(parser.parse(sourcepath, processes=2).show(), tree.show())
+        self.assertGreater(parser.chunks, 1)
+        self.assertEqual(parser.items, expected.items)
+        # split within an occurrence: parsed again sequentially
+        parser.chunk_starts = lambda numchunks: [0, expected.items[1] + 1]
+        self.assertMultiLineEqual(parser.parse(sourcepath, processes=2).show(), tree.show())
+        self.assertEqual(parser.chunks, 0)
+        self.assertIsNone(modsplan.syntax.merge_occurrences([[(0, 3, None)], [(4, 1, None)]]))
+    
+    
+    def test_tracing(self):
+        parser = modsplan.syntax.SyntaxParser('modspecs/calc')
+        sink = parser.tracer.add(modsplan.tracing.ListSink())
+        parser.parse_from('(1+2)')
+        events = sink.events
+        self.assertEqual(str(events[0]), '\n\nParse trace:\n')
+        self.assertEqual([str(event) for event in events if event.kind == 'parsed'][-1],
+                            "expr: '(' INTEGER(1) ADD_OP(+) INTEGER(2) ')'")
+        self.assertEqual(len([event for event in events if event.kind == 'token']), 5)
+        logger = logging.getLogger('modsplan.test')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        parser.tracer.add(modsplan.tracing.LoggingSink(logger, flags='3'))
+        parser.tracer.remove(sink)
+        parser.parse_from('(1+2)')
+        self.assertEqual(len(records), len([event for event in events
+                                            if event.verbosity == '3']))
+        logger.removeHandler(handler)
+    
+    
+    def test_profile(self):
+        for debug, sourcename in [('c', 'diamond_pattern.c1'), ('q', 'gcd.c1')]:
+            parser = modsplan.syntax.SyntaxParser('modspecs/c1', debug)
+            profile = parser.tracer.add(modsplan.profiler.ParseProfile())
+            tree = parser.parse(os.path.join(source_dir, sourcename))
+            numnodes = {}       # parses kept are those in the tree
+            nodes = [tree]
+            while nodes:
+                node = nodes.pop()
+                if not node.isterminal():
+                    numnodes[node.name] = numnodes.get(node.name, 0) + 1
+                    nodes.extend(node.children)
+            for name, counts in profile.nonterms.items():
+                self.assertEqual(counts['successes'] - counts['discarded'],
+                                    numnodes.get(name, 0), '%s with %s' % (name, debug))
+            if 'c' in debug:        # memo hits are kept parses
+                self.assertGreater(sum(counts['memo'] for counts in profile.nonterms.values()),
+                                    0)
+        self.assertGreater(profile.alternates.values()[0]['attempts'], 0)
+        self.assertGreater(sum(counts['backtracked'] for counts in profile.nonterms.values()), 0)
+        report = profile.report('backtracked')
+        backtracked = [counts['backtracked'] for counts in report['nonterms'].values()]
+        self.assertEqual(backtracked, sorted(backtracked, reverse=True))
+        self.assertEqual(json.loads(profile.json()), json.loads(json.dumps(report)))
+    
+    
+    def test_prefix_masks(self):
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1')
+        grammar = parser.syntax
+        parser.parse(os.path.join(source_dir, 'gcd.c1'))
+        alternates = [alt for nonterm in grammar.nonterms.values()
+                        for alt in nonterm.alternates]
+        for token in parser.tokens:
+            bits = grammar.token_mask(token)
+            for rule in grammar.nonterms.values() + alternates:
+                matched = token.text in rule.prefixes or token.name in rule.prefixes
+                self.assertEqual(bool(bits & rule.prefix_mask), matched)
+        # a literal does not match a token kind of the same text
+        token = modsplan.tokenize.Token.at('NAME', 'INTEGER', 0)
+        self.assertFalse(grammar.token_mask(token) & grammar.nonterms['number'].prefix_mask)
+        self.assertIn('INTEGER', grammar.nonterms['number'].prefixes)
+        # masks cached in tokens are for the grammar that parsed them
+        tokens = parser.tokens
+        other = modsplan.syntax.SyntaxParser('modspecs/c1')
+        tree = other.parse_source(parser.source_path, tokens, False)
+        self.assertMultiLineEqual(tree.show(), parser.tree.show())
+        self.assertIs(tokens[0].prefix_mask[0], other.syntax)
+        self.assertEqual(tokens[0].prefix_mask[1], other.syntax.token_mask(tokens[0]))
+    
+    
+    def test_pickle(self):
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1')
+        parser.parse(os.path.join(source_dir, 'squares.c1'))     # gcd.c1 is not file 0
+        tree = parser.parse(os.path.join(source_dir, 'gcd.c1'))
+        data = pickle.dumps(tree, pickle.HIGHEST_PROTOCOL)
+        copy = pickle.loads(data)
+        self.assertMultiLineEqual(copy.show(), tree.show())
+        node = copy.children[-1]
+        self.assertEqual(node.location.line(), tree.children[-1].location.line())
+        
+        # Unpickle in a new process: locations are kept, without lines of text
+        script = ('import pickle, sys\n'
+                  'tree = pickle.load(sys.stdin)\n'
+                  'for node in tree.children[-1], tree.comments[0]:\n'
+                  '    loc = node.location\n'
+                  '    print loc.filepath, loc.linenum, loc.column, repr(loc.line())\n')
+        process = subprocess.Popen([sys.executable, '-c', script], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+        output = process.communicate(data)[0]
+        expected = ''.join('%s %d %d \'\'\n' % (loc.filepath, loc.linenum, loc.column)
+                            for loc in [tree.children[-1].location,
+                                        tree.comments[0].location])
+        self.assertEqual(output, expected)
+    
+    
+    def test_brackets(self):
+        parser = modsplan.syntax.SyntaxParser('modspecs/c1')
+        call = parser.syntax.nonterms['call'].alternates[0]
+        self.assertEqual(call.required, frozenset(['(', ')']))
+        sourcepath = os.path.join(source_dir, 'gcd.c1')
+        tree = parser.parse(sourcepath)
+        tokens = parser.tokens
+        brackets = parser.brackets
+        self.assertTrue(brackets)
+        for opening in brackets.positions['(']:
+            closing = brackets.match[opening]
+            self.assertEqual(tokens[closing].text, ')')
+            for index in range(opening + 1, closing):
+                self.assertLessEqual(brackets.region_end[index], closing)
+        parser.debug += 'k'
+        self.assertMultiLineEqual(parser.parse(sourcepath).show(), tree.show())
+
+
+def describe(token):
+    """ Return string of token with its line and column."""
+    return '%s %d:%d' % (token, token.location.linenum, token.location.column)
+
+
 if __name__ == '__main__':
     unittest.main()
     